@@ -1,9 +1,10 @@
 import numpy as np
-import random as r
 import math
 import time
 from numba import jit, cuda, prange
+from scipy.spatial import cKDTree
 from functools import wraps
+from collections import namedtuple
 
 
 class Base:
@@ -25,7 +26,14 @@ class Base:
         # various other holders
         self.cell_array_names = list()  # store the variable names of each cell array
         self.cell_types = dict()  # hold the names of cell types defined in run.py
+        self.categories = dict()  # hold the labels of each categorical cell array, indexed by the codes in the array
         self.method_times = dict()  # store the runtimes of selected methods, used by record_time() decorator
+        self.spatial_index = SpatialIndex()  # holds the bins for the fixed-radius neighbor searches of a step
+        self.jkr_list = NeighborList()  # holds the candidate pairs of cells for JKR neighbors if using a skin
+        self.derived_values = dict()  # holds values derived from the cell arrays until these arrays change
+        self.rng = RandomStreams()  # the source of all random numbers, remade with the seed from general.txt
+        self.rules = CellRules()  # holds the per-cell rules registered in run.py, see cell_rules() in functions.py
+        self.move_substeps = 0  # the number of movement sub-steps taken in the current step, see relax_mechanics()
 
         # suppresses IDE error, not necessary
         self.graph_names = None
@@ -50,7 +58,8 @@ class Base:
         if cell_type is not None:
             self.cell_types[cell_type] = (begin, self.number_cells)
 
-    def cell_array(self, array_name, cell_type=None, dtype=float, vector=None, func=None, override=None):
+    def cell_array(self, array_name, cell_type=None, dtype=float, vector=None, func=None, override=None,
+                   categories=None):
         """ Create a cell array in the Simulation object used to hold values
             for all cells and optionally specify initial parameters.
 
@@ -60,7 +69,16 @@ class Base:
                 vector (int): the length of the vector for each cell in the array
                 func (object): a function called for each index of the array to specify initial parameters
                 override (array): use the array passed instead of generating a new array
+                categories (list): the labels of a categorical array, which holds the uint8 code of each cell's label
+                    (see get_code()), func should then return labels
         """
+        # if a categorical array, hold the labels and store the codes of the labels as uint8
+        if categories is not None:
+            if len(categories) > 256:
+                raise Exception("A categorical cell array can have at most 256 labels")
+            self.categories[array_name] = list(categories)
+            dtype = np.uint8
+
         # if using existing array for cell array
         if override is not None:
             # make sure array have correct length, otherwise raise error
@@ -99,7 +117,7 @@ class Base:
             # if function is passed, apply initial parameter
             if func is not None:
                 for i in range(self.number_cells):
-                    self.__dict__[array_name][i] = func()
+                    self.__dict__[array_name][i] = self.get_value(array_name, func())
 
         # otherwise a cell type is passed
         else:
@@ -110,80 +128,722 @@ class Base:
             # if function is passed, apply initial parameter to slice
             if func is not None:
                 for i in range(begin, end):
-                    self.__dict__[array_name][i] = func()
+                    self.__dict__[array_name][i] = self.get_value(array_name, func())
+
+    def get_code(self, array_name, label):
+        """ Returns the code held by a categorical cell array for
+            the label.
+
+                array_name (str): the name of the categorical cell array
+                label (str): one of the labels passed to cell_array()
+        """
+        return np.uint8(self.categories[array_name].index(label))
+
+    def get_value(self, array_name, value):
+        """ Returns the value to be held by a cell array, which is
+            the code of the label if the array is categorical.
+        """
+        if array_name in self.categories:
+            return self.get_code(array_name, value)
+        return value
+
+    def get_labels(self, array_name):
+        """ Returns the cell array with each code of a categorical
+            array replaced by its label.
+        """
+        return np.array(self.categories[array_name], dtype=object)[self.__dict__[array_name]]
+
+    def get_derived(self, name):
+        """ Returns a value derived from the cell arrays such as the
+            number of neighbors of each cell, only computing it if it
+            hasn't been computed since the cell arrays last changed.
+
+                name (str): the name of the value, see compute_derived()
+        """
+        if name not in self.derived_values:
+            self.derived_values[name] = compute_derived(self, name)
+        return self.derived_values[name]
+
+    def clear_derived(self):
+        """ Removes the held derived values, used by any method that
+            changes the cell arrays or the neighbor graph.
+        """
+        self.derived_values.clear()
+
+
+def compute_derived(simulation, name):
+    """ Computes a value derived from the cell arrays for the
+        get_derived() method of the Simulation object.
+    """
+    # the number of neighbors of each cell
+    if name == "degrees":
+        return simulation.neighbor_graph.degrees()
+
+    # True/False arrays for the state of each cell
+    elif name == "if_diff":
+        return simulation.states == simulation.get_code("states", "Differentiated")
+    elif name == "if_pluri":
+        return simulation.states == simulation.get_code("states", "Pluripotent")
+
+    # True/False arrays for GATA6 high or NANOG high cells, regardless of state
+    elif name == "if_gata6":
+        return simulation.GATA6 > simulation.NANOG
+    elif name == "if_nanog":
+        return simulation.GATA6 < simulation.NANOG
+
+    # the number of differentiated neighbors of each cell, summed over the neighbors in the CSR arrays
+    elif name == "diff_neighbors":
+        graph = simulation.neighbor_graph
+        rows = np.repeat(np.arange(simulation.number_cells), simulation.get_derived("degrees"))
+        weights = simulation.get_derived("if_diff")[graph.indices]
+        return np.bincount(rows, weights=weights, minlength=simulation.number_cells).astype(int)
+
+    else:
+        raise Exception("Unknown name for the get_derived() method")
+
+
+class RandomStreams:
+    """ This object is the source of random numbers for the simulation, using a
+        NumPy Generator for drawing arrays of random numbers at once and keys
+        for counter-based streams of random numbers for each cell within
+        compiled functions (see cell_random()). The Generator is pickled with
+        the Simulation object, so a continued simulation picks up the same
+        sequence of random numbers.
+    """
+    def __init__(self, seed=None):
+        self.seed = seed  # the seed of the Generator, None for a different seed each time
+        self.generator = np.random.default_rng(seed)  # the NumPy Generator used for all draws
+
+    def random(self, size=None):
+        """ Returns random floats in [0, 1).
+        """
+        return self.generator.random(size)
+
+    def integers(self, low, high, size=None):
+        """ Returns random integers in [low, high).
+        """
+        return self.generator.integers(low, high, size)
+
+    def stream_key(self):
+        """ Returns a key for the counter-based streams of random
+            numbers for each cell, drawn from the Generator such that
+            each call gives different streams. See cell_random().
+        """
+        return int(self.generator.integers(0, 2 ** 63))
+
+
+class CellRules:
+    """ This object holds the per-cell rules registered in run.py and fuses them
+        into a single compiled pass over all of the cells, in which each rule
+        is called in order for one cell before moving to the next cell.
+
+        A rule is a function rule(index, cells, params) that numba can compile
+        in nopython mode. The cells record holds the cell arrays named when
+        registering the rule, the derived values (see compute_derived()) named
+        in RULE_DERIVED, and the "divide" and "remove" True/False arrays used
+        to add cells to the queues. The params record holds the Simulation
+        attributes named when registering the rule and a "key" for
+        cell_random(). As the cells are handled in parallel, a rule must only
+        change the values at its index.
+    """
+    def __init__(self):
+        self.rules = list()  # the registered rule functions, called in this order for each cell
+        self.params = list()  # the names of the Simulation attributes passed to the rules
+        self.arrays = list()  # the names of the cell arrays passed to the rules
+        self.kernel = None  # the compiled pass over all cells, made the first time the rules are run
+
+    def __getstate__(self):
+        """ Don't pickle the compiled pass, which is remade when a
+            continued simulation first runs the rules.
+        """
+        state = self.__dict__.copy()
+        state["kernel"] = None
+        return state
+
+    def register(self, rule, *params, arrays=()):
+        """ Adds a rule to the end of the rules run for each cell.
+
+                rule (function): the rule, see CellRules
+                params (str): the names of the Simulation attributes used by the rule as parameters
+                arrays (list): the names of the cell arrays used by the rule, which must be numeric
+        """
+        self.rules.append(rule)
+        for name in params:
+            if name not in self.params:
+                self.params.append(name)
+        for name in arrays:
+            if name not in self.arrays:
+                self.arrays.append(name)
+
+        # the rules must be fused again
+        self.kernel = None
+
+    def run(self, simulation):
+        """ Calls each of the rules for all cells and returns the True/False
+            arrays of the cells to divide and the cells to remove.
+        """
+        # hold the cell arrays used by the rules and the derived values by name along with the arrays for the cells
+        # to divide/remove, other cell arrays may not be numeric (such as str arrays) so these aren't passed
+        cells = {name: simulation.__dict__[name] for name in self.arrays}
+        for name in RULE_DERIVED:
+            cells[name] = simulation.get_derived(name)
+        cells["divide"] = np.zeros(simulation.number_cells, dtype=np.bool_)
+        cells["remove"] = np.zeros(simulation.number_cells, dtype=np.bool_)
+
+        # hold the parameters by name, with a new key for the random numbers of the cells each time
+        params = {name: simulation.__dict__[name] for name in self.params}
+        params["key"] = simulation.rng.stream_key()
+
+        # compile the rules into one pass over the cells if not done already
+        if self.kernel is None:
+            self.kernel = fuse_rules(self.rules)
+
+        # call the rules for each cell
+        self.kernel(simulation.number_cells, make_record("Cells", cells), make_record("Params", params))
+
+        return cells["divide"], cells["remove"]
+
+
+# the derived values held by the cells record of the rules, see CellRules
+RULE_DERIVED = ["degrees", "if_pluri", "if_diff", "if_gata6", "if_nanog", "diff_neighbors"]
+
+# the namedtuple types of the records passed to the rules, reused such that numba doesn't compile the rules again
+record_types = dict()
+
+
+def make_record(type_name, values):
+    """ Returns a namedtuple of the values by name, which numba
+        passes to compiled functions as a record.
+    """
+    # get the namedtuple type for these names, making a new type only if one doesn't exist already
+    names = tuple(values.keys())
+    if (type_name, names) not in record_types:
+        record_types[(type_name, names)] = namedtuple(type_name, names)
+
+    return record_types[(type_name, names)](**values)
+
+
+@jit(nopython=True)
+def no_rule(index, cells, params):
+    """ The start of the chain of rules made by fuse_rules(),
+        which does nothing to the cell.
+    """
+    pass
+
+
+def chain_rules(first, second):
+    """ Returns a compiled function that calls the compiled function
+        "first" and then the compiled function "second" for a cell.
+    """
+    @jit(nopython=True)
+    def chained(index, cells, params):
+        first(index, cells, params)
+        second(index, cells, params)
+
+    return chained
+
+
+def fuse_rules(rules):
+    """ Returns a compiled function that calls each of the rules in
+        order for every cell in parallel, see CellRules.
+    """
+    # chain the compiled version of each rule in order, such that a rule that fails to compile is reported with its
+    # own source
+    call_rules = no_rule
+    for rule in rules:
+        call_rules = chain_rules(call_rules, jit(nopython=True)(rule))
+
+    # the pass over the cells (not cached, as the chain of rules is made when the simulation runs)
+    @jit(nopython=True, parallel=True)
+    def rules_cpu(number_cells, cells, params):
+        for index in prange(number_cells):
+            call_rules(index, cells, params)
+
+    return rules_cpu
+
+
+class SpatialIndex:
+    """ This object holds the bins used by the fixed-radius neighbor searches,
+        such that all searches of the same bin width can share one assignment
+        of the cells to bins until the cells move, divide, or die.
+    """
+    def __init__(self):
+        self.grids = dict()  # the bins, bins_help, bins_start, bins_table, and bin_locations arrays for each bin width
+        self.tree = None  # the k-d tree of the cell locations, used instead of bins if specified
+        self.locations = None  # a copy of the cell locations when the held bins were made
+
+    def __getstate__(self):
+        """ Don't pickle any held bins or k-d tree as these will
+            be remade from the cell locations when needed.
+        """
+        state = self.__dict__.copy()
+        state["grids"] = dict()
+        state["tree"] = None
+        state["locations"] = None
+        return state
+
+    def check_locations(self, simulation):
+        """ Clears the held bins and k-d tree if the cell locations
+            have changed since they were made.
+        """
+        # if the cell locations have changed, the held bins no longer represent the cells, only the locations of the
+        # current cells are used as the cell arrays may already hold cells being added by update_queue()
+        locations = simulation.locations[:simulation.number_cells]
+        if self.locations is None or not np.array_equal(self.locations, locations):
+            self.grids.clear()
+            self.tree = None
+            self.locations = locations.copy()
+
+    def get_bins(self, simulation, distance):
+        """ Returns the bins, bins_help, bins_start, bins_table, and
+            bin_locations arrays for the bin width, only assigning the
+            cells to bins if the cell locations have changed since they
+            were last assigned.
+        """
+        # make sure the held bins still represent the cells
+        self.check_locations(simulation)
+
+        # if there are no bins held for this bin width, assign the cells to bins
+        if distance not in self.grids:
+            self.grids[distance] = assign_bins(simulation, distance)
+
+        return self.grids[distance]
+
+    def get_tree(self, simulation):
+        """ Returns a k-d tree of the cell locations, only making
+            the tree if the cell locations have changed since it
+            was last made.
+        """
+        # make sure the held k-d tree still represents the cells
+        self.check_locations(simulation)
+
+        # if there is no k-d tree held, make one
+        if self.tree is None:
+            self.tree = cKDTree(simulation.locations[:simulation.number_cells])
+
+        return self.tree
+
+
+class NeighborList:
+    """ This object holds candidate pairs of cells found with a search radius
+        padded by a skin (a Verlet list). The pairs can be reused to find any
+        interactions until a cell has moved more than half of the skin.
+    """
+    def __init__(self):
+        self.pairs = None  # the candidate pairs of cells
+        self.locations = None  # a copy of the cell locations when the candidate pairs were found
+        self.reach = 0  # the furthest distance apart two cells could interact when the candidate pairs were found
+
+    def clear(self):
+        """ Removes the candidate pairs, used when the cell indices
+            change from division or death.
+        """
+        self.pairs = None
+        self.locations = None
+
+    def needs_update(self, locations, reach, skin):
+        """ Determines if the candidate pairs need to be found again
+            based on the movement of the cells since the pairs were
+            found and any change in the interaction distance.
+        """
+        # if there are no pairs, the number of cells has changed, or the cells may now interact further apart
+        if self.pairs is None or self.locations.shape != locations.shape or reach > self.reach:
+            return True
+
+        # get the largest distance a cell has moved since the pairs were found
+        displacement = np.sqrt(np.amax(np.sum((locations - self.locations) ** 2, axis=1), initial=0))
+
+        # two cells can only have come within the reach if both have moved, so half the skin is allowed for each
+        return displacement > skin / 2
+
+    def update(self, pairs, locations, reach):
+        """ Holds the new candidate pairs and the cell locations
+            used to find them.
+        """
+        self.pairs = pairs
+        self.locations = locations.copy()
+        self.reach = reach
+
+    def contacts(self, locations, radii):
+        """ Returns the candidate pairs where the cells have 0 or
+            more overlap.
+        """
+        return get_contacts(self.pairs, locations, radii)
+
+
+class AdjacencyGraph:
+    """ This object holds an undirected graph of the cells as compressed
+        sparse row (CSR) arrays, where the neighbors of cell i are
+        indices[indptr[i]:indptr[i + 1]]. It mirrors the parts of the
+        igraph interface used by the model, such that these arrays can
+        be passed directly to compiled functions.
+    """
+    def __init__(self):
+        self.indptr = np.zeros(1, dtype=int)  # where the neighbors of each vertex begin in "indices"
+        self.indices = np.zeros(0, dtype=int)  # the neighbors of each vertex, sorted by vertex
+
+    def vcount(self):
+        """ Returns the number of vertices.
+        """
+        return len(self.indptr) - 1
+
+    def ecount(self):
+        """ Returns the number of edges.
+        """
+        return len(self.indices) // 2
+
+    def add_vertices(self, number):
+        """ Adds vertices without any edges to the end of the graph.
+        """
+        self.indptr = np.append(self.indptr, np.repeat(self.indptr[-1], number))
+
+    def add_vertex(self):
+        """ Adds a single vertex without any edges to the end of
+            the graph.
+        """
+        self.add_vertices(1)
+
+    def delete_vertices(self, vertices):
+        """ Removes the vertices and their edges, shifting the indices
+            of the remaining vertices down to fill the gaps.
+        """
+        # get the new index of each remaining vertex, -1 for removed vertices
+        keep = np.ones(self.vcount(), dtype=bool)
+        keep[vertices] = False
+        new_index = np.where(keep, np.cumsum(keep) - 1, -1)
+
+        # keep only the edges between remaining vertices, using their new indices
+        edges = new_index[self.get_edgelist()]
+        edges = edges[np.all(edges != -1, axis=1)]
+        self.set_edges(edges, np.sum(keep))
+
+    def delete_edges(self):
+        """ Removes all edges from the graph.
+        """
+        self.set_edges(np.zeros((0, 2), dtype=int))
+
+    def add_edges(self, edges):
+        """ Adds the edges to those already in the graph.
+        """
+        self.set_edges(np.concatenate((self.get_edgelist(), np.reshape(edges, (-1, 2)))))
+
+    def set_edges(self, edges, number_vertices=None):
+        """ Replaces the edges of the graph with the array of edges,
+            building the CSR arrays with each edge held in both
+            directions.
+        """
+        # keep the same number of vertices unless specified
+        if number_vertices is None:
+            number_vertices = self.vcount()
+
+        # hold each edge in both directions and sort by vertex then neighbor
+        edges = np.reshape(edges, (-1, 2)).astype(int)
+        rows = np.concatenate((edges[:, 0], edges[:, 1]))
+        columns = np.concatenate((edges[:, 1], edges[:, 0]))
+        order = np.lexsort((columns, rows))
+
+        # get where the neighbors of each vertex begin from the running total of the degrees
+        self.indptr = np.zeros(number_vertices + 1, dtype=int)
+        np.cumsum(np.bincount(rows, minlength=number_vertices), out=self.indptr[1:])
+        self.indices = columns[order]
+
+    def get_edgelist(self):
+        """ Returns an array of the edges, each held once with the
+            lower index first.
+        """
+        rows = np.repeat(np.arange(self.vcount()), np.diff(self.indptr))
+        edges = np.stack((rows, self.indices), axis=1)
+        return edges[rows < self.indices]
+
+    def neighbors(self, vertex):
+        """ Returns the neighbors of the vertex.
+        """
+        return self.indices[self.indptr[vertex]:self.indptr[vertex + 1]]
+
+    def degrees(self):
+        """ Returns the number of neighbors of each vertex.
+        """
+        return np.diff(self.indptr)
+
+    def to_igraph(self):
+        """ Returns the graph as an igraph Graph, which is only
+            imported if the graph is exported.
+        """
+        import igraph
+        return igraph.Graph(n=self.vcount(), edges=self.get_edgelist().tolist())
 
 
-def assign_bins(simulation, distance, max_cells):
+class BondGraph:
+    """ This object holds the edges of an undirected graph as a sorted
+        array of unique pairs, each with the lower index first. It's
+        used for the JKR bonds, where the array of edges is passed
+        directly to the force functions and the bonds are updated with
+        vectorized merges and deletions instead of igraph calls.
+    """
+    def __init__(self):
+        self.number_vertices = 0  # the number of vertices in the graph
+        self.edges = np.zeros((0, 2), dtype=np.int64)  # the unique edges, sorted by lower then higher index
+
+    def vcount(self):
+        """ Returns the number of vertices.
+        """
+        return self.number_vertices
+
+    def ecount(self):
+        """ Returns the number of edges.
+        """
+        return len(self.edges)
+
+    def add_vertices(self, number):
+        """ Adds vertices without any edges to the end of the graph.
+        """
+        self.number_vertices += number
+
+    def add_vertex(self):
+        """ Adds a single vertex without any edges to the end of
+            the graph.
+        """
+        self.add_vertices(1)
+
+    def delete_vertices(self, vertices):
+        """ Removes the vertices and their edges, shifting the indices
+            of the remaining vertices down to fill the gaps.
+        """
+        # get the new index of each remaining vertex, -1 for removed vertices
+        keep = np.ones(self.number_vertices, dtype=bool)
+        keep[vertices] = False
+        new_index = np.where(keep, np.cumsum(keep) - 1, -1)
+
+        # keep only the edges between remaining vertices, the shift preserves the order of the edges
+        edges = new_index[self.edges].astype(np.int64)
+        self.edges = edges[np.all(edges != -1, axis=1)]
+        self.number_vertices = int(np.sum(keep))
+
+    def delete_edges(self, edges=None):
+        """ Removes the edges marked by a boolean mask of the array of
+            edges, or all edges if no mask is specified.
+        """
+        if edges is None:
+            self.edges = np.zeros((0, 2), dtype=np.int64)
+        else:
+            self.edges = self.edges[~edges]
+
+    def add_edges(self, edges):
+        """ Adds the edges, merging them with the edges already in the
+            graph such that each edge is held once.
+        """
+        # put the lower index first for each of the new edges, using 64-bit integers such that the keys below don't
+        # overflow where the default integer is 32-bit
+        edges = np.sort(np.reshape(edges, (-1, 2)).astype(np.int64), axis=1)
+
+        # pack each edge into a single integer key, where the unique keys are sorted by the lower index then the
+        # higher index, and unpack the keys into edges
+        held = self.edges.astype(np.int64, copy=False)
+        keys = np.concatenate((held[:, 0] << 32 | held[:, 1], edges[:, 0] << 32 | edges[:, 1]))
+        keys = np.unique(keys)
+        self.edges = np.stack((keys >> 32, keys & 0xFFFFFFFF), axis=1)
+
+    def set_edges(self, edges):
+        """ Replaces the edges with an array of unique edges, already
+            sorted with the lower index first.
+        """
+        self.edges = edges.astype(np.int64, copy=False)
+
+    def get_edgelist(self):
+        """ Returns the array of edges, each held once with the lower
+            index first.
+        """
+        return self.edges
+
+    def to_igraph(self):
+        """ Returns the graph as an igraph Graph, which is only
+            imported if the graph is exported.
+        """
+        import igraph
+        return igraph.Graph(n=self.number_vertices, edges=self.edges.tolist())
+
+
+def get_contacts(pairs, locations, radii):
+    """ Returns the pairs of cells that have 0 or more overlap.
+    """
+    # get the magnitude of the distance vector between the cell locations for each pair
+    cell_1, cell_2 = pairs[:, 0], pairs[:, 1]
+    mag = np.linalg.norm(locations[cell_1] - locations[cell_2], axis=1)
+
+    # calculate the overlap of the cells and keep the pairs with 0 or more overlap
+    overlap = radii[cell_1] + radii[cell_2] - mag
+    return pairs[overlap >= 0]
+
+
+def nearest_tree(locations, of_type, distance):
+    """ Uses a k-d tree of the cells of a type to find the nearest
+        cell of that type within a fixed radius for each cell, -1
+        if there is no cell.
+    """
+    # get the indices of the cells of the type, if there are none then no cell has a nearest cell of the type
+    indices = np.flatnonzero(of_type)
+    if len(indices) == 0:
+        return -1 * np.ones(len(locations), dtype=int)
+
+    # find the two nearest cells of the type as a cell may find itself, a missing cell has the index len(indices)
+    tree = cKDTree(locations[indices])
+    upper_bound = np.nextafter(distance, np.inf)    # include cells at exactly the search radius
+    mags, places = tree.query(locations, k=2, distance_upper_bound=upper_bound)
+
+    # turn the places in the tree back into cell indices, using -1 for no cell
+    holder = np.append(indices, -1)
+    nearest = holder[places]
+
+    # if the nearest cell is the cell itself use the second nearest
+    itself = nearest[:, 0] == np.arange(len(locations))
+    return np.where(itself, nearest[:, 1], nearest[:, 0])
+
+
+def assign_bins(simulation, distance):
     """ Generalizes cell locations to a bin within lattice imposed on
         the cell space, used for a parallel fixed-radius neighbor search.
+        The cells are sorted by bin such that the cells of a bin are
+        found with the bin's count and starting index. Only bins holding
+        cells are kept, which are found through a hash table of bin keys.
     """
-    # If there is enough space for all cells that should be in a bin, break out of the loop. If there isn't
-    # update the amount of needed space and put all the cells in bins. This will run once if the prediction
-    # of max neighbors suffices, twice if it isn't right the first time.
-    while True:
-        # calculate the size of the array used to represent the bins and the bins helper array, include extra bins
-        # for cells that may fall outside of the space
-        bins_help_size = np.ceil(simulation.size / distance).astype(int) + 3
-        bins_size = np.append(bins_help_size, max_cells)
-
-        # create the arrays for "bins" and "bins_help"
-        bins_help = np.zeros(bins_help_size, dtype=int)    # holds the number of cells currently in a bin
-        bins = np.empty(bins_size, dtype=int)    # holds the indices of cells in a bin
-
-        # generalize the cell locations to bin indices and offset by 1 to prevent missing cells that fall out of the
-        # simulation space
-        bin_locations = np.floor_divide(simulation.locations, distance).astype(int)
-        bin_locations += 1
-
-        # use jit function to speed up placement of cells
-        bins, bins_help = assign_bins_jit(simulation.number_cells, bin_locations, bins, bins_help)
-
-        # either break the loop if all cells were accounted for or revalue the maximum number of cells based on
-        # the output of the function call and double it future calls
-        new_max_cells = np.amax(bins_help)
-        if max_cells >= new_max_cells:
-            break
-        else:
-            max_cells = new_max_cells * 2   # double to prevent continual updating
+    # generalize the locations of the current cells to bin indices and offset by 1 to prevent missing cells that fall
+    # out of the simulation space
+    bin_locations = np.floor_divide(simulation.locations[:simulation.number_cells], distance).astype(int)
+    bin_locations += 1
+
+    # use jit function to speed up placement of cells
+    bins, bins_help, bins_start, bins_table = assign_bins_jit(bin_locations)
+
+    return bins, bins_help, bins_start, bins_table, bin_locations
+
+
+def assign_type_bins(bin_locations, of_type):
+    """ Places only the cells of a type in bins, using the bin locations
+        of all cells. The sorted "bins" array holds positions in the
+        returned "indices" array, which are the cell indices of the type.
+    """
+    # get the indices of the cells of the type and sort these cells by bin
+    indices = np.flatnonzero(of_type)
+    bins, bins_help, bins_start, bins_table = assign_bins_jit(bin_locations[indices])
 
-    return bins, bins_help, bin_locations, max_cells
+    return indices, bins, bins_help, bins_start, bins_table
 
 
 @jit(nopython=True, cache=True)
-def assign_bins_jit(number_cells, bin_locations, bins, bins_help):
-    """ A just-in-time compiled function for assign_bins() that places
-        the cells in their respective bins.
+def bin_key(x, y, z):
+    """ Packs the indices of a bin into a single integer, using 21 bits
+        for each index.
     """
-    # go through all cells
-    for index in range(number_cells):
-        # get the indices of the generalized cell location
-        x, y, z = bin_locations[index]
+    return ((x & 2097151) << 42) | ((y & 2097151) << 21) | (z & 2097151)
+
+
+@jit(nopython=True, cache=True)
+def bin_hash(key, mask):
+    """ Scatters a bin key across the hash table with a multiplicative
+        hash, where the mask is the size of the table minus one.
+    """
+    return np.int64((np.uint64(key) * np.uint64(11400714819323198485)) >> np.uint64(40)) & mask
+
+
+@jit(nopython=True, cache=True)
+def find_bin(bins_table, x, y, z):
+    """ Returns the position of a bin in the "bins_help" and "bins_start"
+        arrays or -1 if the bin holds no cells.
+    """
+    key = bin_key(x, y, z)
+    mask = bins_table.shape[0] - 1
+    index = bin_hash(key, mask)
+
+    # probe the table until the bin is found or an empty entry is reached
+    while bins_table[index][0] != -1:
+        if bins_table[index][0] == key:
+            return bins_table[index][1]
+        index = (index + 1) & mask
+    return -1
+
 
-        # use the help array to get the new index for the cell in the bin
-        place = bins_help[x][y][z]
+@cuda.jit(device=True)
+def find_bin_gpu(bins_table, x, y, z):
+    """ The device version of find_bin(), returning the position of a bin
+        in the "bins_help" and "bins_start" arrays or -1 if it's empty.
+    """
+    key = ((x & 2097151) << 42) | ((y & 2097151) << 21) | (z & 2097151)
+    mask = bins_table.shape[0] - 1
+    index = np.int64((np.uint64(key) * np.uint64(11400714819323198485)) >> np.uint64(40)) & mask
 
-        # adds the index in the cell array to the bin
-        bins[x][y][z][place] = index
+    # probe the table until the bin is found or an empty entry is reached
+    while bins_table[index, 0] != -1:
+        if bins_table[index, 0] == key:
+            return bins_table[index, 1]
+        index = (index + 1) & mask
+    return -1
+
+
+@jit(nopython=True, cache=True)
+def assign_bins_jit(bin_locations):
+    """ A just-in-time compiled function for assign_bins() that sorts the
+        cells by bin key, records the count and starting index of each
+        occupied bin, and builds the hash table for finding these bins.
+    """
+    number_cells = bin_locations.shape[0]
+
+    # get the key of the bin for each cell and sort the cells by these keys
+    keys = np.empty(number_cells, dtype=np.int64)
+    for index in range(number_cells):
+        keys[index] = bin_key(bin_locations[index][0], bin_locations[index][1], bin_locations[index][2])
+    bins = np.argsort(keys, kind="mergesort")
+
+    # count the number of bins that hold cells
+    occupied = 0
+    for place in range(number_cells):
+        if place == 0 or keys[bins[place]] != keys[bins[place - 1]]:
+            occupied += 1
+
+    # make the hash table a power of two that is at least twice the number of occupied bins, where each entry holds
+    # the key of a bin and its position in the "bins_help" and "bins_start" arrays
+    table_size = 2
+    while table_size < 2 * occupied:
+        table_size *= 2
+    bins_table = np.full((table_size, 2), -1, dtype=np.int64)
+    mask = table_size - 1
+
+    # create the arrays for the number of cells in a bin and the index in "bins" where a bin begins
+    bins_help = np.zeros(occupied, dtype=np.int64)
+    bins_start = np.empty(occupied, dtype=np.int64)
+
+    # go through the sorted cells, starting a new bin each time the key changes
+    slot = -1
+    for place in range(number_cells):
+        key = keys[bins[place]]
+        if place == 0 or key != keys[bins[place - 1]]:
+            slot += 1
+            bins_start[slot] = place
+
+            # insert the bin into the hash table with linear probing
+            index = bin_hash(key, mask)
+            while bins_table[index][0] != -1:
+                index = (index + 1) & mask
+            bins_table[index][0] = key
+            bins_table[index][1] = slot
 
         # update the number of cells in a bin
-        bins_help[x][y][z] += 1
+        bins_help[slot] += 1
 
     # return the arrays now filled with cell indices
-    return bins, bins_help
+    return bins, bins_help, bins_start, bins_table
 
 
 @cuda.jit
-def get_neighbors_gpu(bin_locations, locations, bins, bins_help, distance, edge_holder, if_edge, edge_count,
-                      max_neighbors):
+def get_neighbors_gpu(bin_locations, locations, bins, bins_help, bins_start, bins_table, distance, edge_holder,
+                      edge_start, edge_count, fill):
     """ A just-in-time compiled cuda kernel for the get_neighbors()
-        method that performs the actual calculations.
+        method that performs the actual calculations. This is called
+        once to count the edges of each cell and again to fill the
+        edge holder array with the edges.
     """
     # get the index in the array
     focus = cuda.grid(1)
 
-    # get the starting index for writing to the edge holder array
-    start = focus * max_neighbors[0]
-
     # double check that focus index is within the array
     if focus < bin_locations.shape[0]:
         # holds the total amount of edges for a given cell
@@ -196,26 +856,28 @@ def get_neighbors_gpu(bin_locations, locations, bins, bins_help, distance, edge_
         for i in range(-1, 2):
             for j in range(-1, 2):
                 for k in range(-1, 2):
-                    # get the count of cells for the current bin
-                    bin_count = bins_help[x + i][y + j][z + k]
+                    # find where the current bin is held, skipping it if there are no cells in it
+                    slot = find_bin_gpu(bins_table, x + i, y + j, z + k)
+                    if slot == -1:
+                        continue
+
+                    # get the count of cells for the current bin and where the bin begins in the sorted cells
+                    bin_count = bins_help[slot]
+                    bin_start = bins_start[slot]
 
                     # go through the bin determining if a cell is a neighbor
-                    for l in range(bin_count):
+                    for l in range(bin_start, bin_start + bin_count):
                         # get the index of the current potential neighbor
-                        current = bins[x + i][y + j][z + k][l]
+                        current = bins[l]
 
                         # check to see if that cell is within the search radius and only continue if the current cell
                         # has a higher index to prevent double counting edges
                         if magnitude(locations[focus], locations[current]) <= distance[0] and focus < current:
-                            # if less than the max edges, add the edge
-                            if cell_edge_count < max_neighbors[0]:
-                                # get the index for the edge
-                                index = start + cell_edge_count
-
-                                # update the edge array and identify that this edge exists
+                            # if filling the edge holder, add the edge after the edges of the previous cells
+                            if fill[0]:
+                                index = edge_start[focus] + cell_edge_count
                                 edge_holder[index][0] = focus
                                 edge_holder[index][1] = current
-                                if_edge[index] = 1
 
                             # increase the count of edges for a cell and the index for the next edge
                             cell_edge_count += 1
@@ -225,15 +887,18 @@ def get_neighbors_gpu(bin_locations, locations, bins, bins_help, distance, edge_
 
 
 @jit(nopython=True, parallel=True, cache=True)
-def get_neighbors_cpu(number_cells, bin_locations, locations, bins, bins_help, distance, edge_holder, if_edge,
-                      edge_count, max_neighbors):
+def get_neighbors_cpu(number_cells, bin_locations, locations, bins, bins_help, bins_start, bins_table, distance,
+                      edge_holder, edge_start, edge_count, fill):
     """ A just-in-time compiled function for the get_neighbors()
-        method that performs the actual calculations.
+        method that performs the actual calculations. This is called
+        once to count the edges of each cell and again to fill the
+        edge holder array with the edges. Each pair of cells is only
+        checked once by searching half of the surrounding bins.
     """
-    # loops over all cells, with the current cell index being the focus
-    for focus in prange(number_cells):
-        # get the starting index for writing to the edge holder array
-        start = focus * max_neighbors
+    # loops over the cells in the order they are sorted by bin, with the current cell index being the focus
+    for place in prange(number_cells):
+        # get the index of the cell
+        focus = bins[place]
 
         # holds the total amount of edges for a given cell
         cell_edge_count = 0
@@ -241,30 +906,43 @@ def get_neighbors_cpu(number_cells, bin_locations, locations, bins, bins_help, d
         # get the bin location of the cell
         x, y, z = bin_locations[focus]
 
-        # go through the surrounding bins including the bin the cell is in
-        for i in range(-1, 2):
+        # go through the bin the cell is in and the 13 surrounding bins ahead of it, the pairs with the 13 bins behind
+        # it are checked by the cells in those bins
+        for i in range(0, 2):
             for j in range(-1, 2):
                 for k in range(-1, 2):
-                    # get the count of cells for the current bin
-                    bin_count = bins_help[x + i][y + j][z + k]
+                    # skip the bins behind the bin the cell is in
+                    if i == 0 and (j == -1 or (j == 0 and k == -1)):
+                        continue
+
+                    # find where the current bin is held, skipping it if there are no cells in it
+                    slot = find_bin(bins_table, x + i, y + j, z + k)
+                    if slot == -1:
+                        continue
+
+                    # get the count of cells for the current bin and where the bin begins in the sorted cells
+                    bin_count = bins_help[slot]
+                    bin_start = bins_start[slot]
+
+                    # in the bin the cell is in, only check the cells after it to prevent double counting edges
+                    if i == 0 and j == 0 and k == 0:
+                        bin_first = place + 1
+                    else:
+                        bin_first = bin_start
 
                     # go through the bin determining if a cell is a neighbor
-                    for l in range(bin_count):
+                    for l in range(bin_first, bin_start + bin_count):
                         # get the index of the current potential neighbor
-                        current = bins[x + i][y + j][z + k][l]
+                        current = bins[l]
 
-                        # check to see if that cell is within the search radius and only continue if the current cell
-                        # has a higher index to prevent double counting edges
-                        if np.linalg.norm(locations[current] - locations[focus]) <= distance and focus < current:
-                            # if less than the max edges, add the edge
-                            if cell_edge_count < max_neighbors:
-                                # get the index for the edge
-                                index = start + cell_edge_count
-
-                                # update the edge array and identify that this edge exists
-                                edge_holder[index][0] = focus
-                                edge_holder[index][1] = current
-                                if_edge[index] = 1
+                        # check to see if that cell is within the search radius
+                        if np.linalg.norm(locations[current] - locations[focus]) <= distance:
+                            # if filling the edge holder, add the edge after the edges of the previous cells with the
+                            # lower index first
+                            if fill:
+                                index = edge_start[focus] + cell_edge_count
+                                edge_holder[index][0] = min(focus, current)
+                                edge_holder[index][1] = max(focus, current)
 
                             # increase the count of edges for a cell and the index for the next edge
                             cell_edge_count += 1
@@ -272,23 +950,91 @@ def get_neighbors_cpu(number_cells, bin_locations, locations, bins, bins_help, d
         # update the array with number of edges for the cell
         edge_count[focus] = cell_edge_count
 
-    return edge_holder, if_edge, edge_count
+    return edge_holder, edge_count
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def get_neighbors_cpu_2d(number_cells, bin_locations, locations, bins, bins_help, bins_start, bins_table, distance,
+                         edge_holder, edge_start, edge_count, fill):
+    """ A version of get_neighbors_cpu() for a 2D space that only
+        searches the surrounding bins in the xy-plane and uses the
+        x and y distances between cells.
+    """
+    # loops over the cells in the order they are sorted by bin, with the current cell index being the focus
+    for place in prange(number_cells):
+        # get the index of the cell
+        focus = bins[place]
+
+        # holds the total amount of edges for a given cell
+        cell_edge_count = 0
+
+        # get the bin location of the cell, all cells are in the same z bin
+        x, y, z = bin_locations[focus]
+
+        # go through the bin the cell is in and the 4 surrounding bins ahead of it, the pairs with the 4 bins behind
+        # it are checked by the cells in those bins
+        for i in range(0, 2):
+            for j in range(-1, 2):
+                # skip the bins behind the bin the cell is in
+                if i == 0 and j == -1:
+                    continue
+
+                # find where the current bin is held, skipping it if there are no cells in it
+                slot = find_bin(bins_table, x + i, y + j, z)
+                if slot == -1:
+                    continue
+
+                # get the count of cells for the current bin and where the bin begins in the sorted cells
+                bin_count = bins_help[slot]
+                bin_start = bins_start[slot]
+
+                # in the bin the cell is in, only check the cells after it to prevent double counting edges
+                if i == 0 and j == 0:
+                    bin_first = place + 1
+                else:
+                    bin_first = bin_start
+
+                # go through the bin determining if a cell is a neighbor
+                for l in range(bin_first, bin_start + bin_count):
+                    # get the index of the current potential neighbor
+                    current = bins[l]
+
+                    # get the distance between the cells
+                    dx = locations[current][0] - locations[focus][0]
+                    dy = locations[current][1] - locations[focus][1]
+                    mag = math.sqrt(dx * dx + dy * dy)
+
+                    # check to see if that cell is within the search radius
+                    if mag <= distance:
+                        # if filling the edge holder, add the edge after the edges of the previous cells with the
+                        # lower index first
+                        if fill:
+                            index = edge_start[focus] + cell_edge_count
+                            edge_holder[index][0] = min(focus, current)
+                            edge_holder[index][1] = max(focus, current)
+
+                        # increase the count of edges for a cell and the index for the next edge
+                        cell_edge_count += 1
+
+        # update the array with number of edges for the cell
+        edge_count[focus] = cell_edge_count
+
+    return edge_holder, edge_count
 
 
 @cuda.jit
-def jkr_neighbors_gpu(bin_locations, locations, radii, bins, bins_help, edge_holder, if_edge, edge_count,
-                      max_neighbors):
+def jkr_neighbors_gpu(bin_locations, locations, radii, bins, bins_help, bins_start, bins_table, edge_holder, edge_start,
+                      edge_count, fill):
     """ A just-in-time compiled cuda kernel for the jkr_neighbors()
-        method that performs the actual calculations.
+        method that performs the actual calculations. This is called
+        once to count the edges of each cell and again to fill the
+        edge holder array with the edges.
     """
     # get the index in the array
     focus = cuda.grid(1)
 
-    # get the starting index for writing to the edge holder array
-    start = focus * max_neighbors[0]
-
     # double check that focus index is within the array
-    if focus < locations.shape[0]:
+    if focus < bin_locations.shape[0]:
         # holds the total amount of edges for a given cell
         cell_edge_count = 0
 
@@ -299,13 +1045,19 @@ def jkr_neighbors_gpu(bin_locations, locations, radii, bins, bins_help, edge_hol
         for i in range(-1, 2):
             for j in range(-1, 2):
                 for k in range(-1, 2):
-                    # get the count of cells for the current bin
-                    bin_count = bins_help[x + i][y + j][z + k]
+                    # find where the current bin is held, skipping it if there are no cells in it
+                    slot = find_bin_gpu(bins_table, x + i, y + j, z + k)
+                    if slot == -1:
+                        continue
+
+                    # get the count of cells for the current bin and where the bin begins in the sorted cells
+                    bin_count = bins_help[slot]
+                    bin_start = bins_start[slot]
 
                     # go through the bin determining if a cell is a neighbor
-                    for l in range(bin_count):
+                    for l in range(bin_start, bin_start + bin_count):
                         # get the index of the current potential neighbor
-                        current = bins[x + i][y + j][z + k][l]
+                        current = bins[l]
 
                         # get the magnitude of the distance vector between the cell locations
                         mag = magnitude(locations[focus], locations[current])
@@ -316,15 +1068,11 @@ def jkr_neighbors_gpu(bin_locations, locations, radii, bins, bins_help, edge_hol
                         # if there is 0 or more overlap and if the current cell has a higher index to prevent double
                         # counting edges
                         if overlap >= 0 and focus < current:
-                            # if less than the max edges, add the edge
-                            if cell_edge_count < max_neighbors[0]:
-                                # get the index for the edge
-                                index = start + cell_edge_count
-
-                                # update the edge array and identify that this edge exists
+                            # if filling the edge holder, add the edge after the edges of the previous cells
+                            if fill[0]:
+                                index = edge_start[focus] + cell_edge_count
                                 edge_holder[index][0] = focus
                                 edge_holder[index][1] = current
-                                if_edge[index] = 1
 
                             # increase the count of edges for a cell and the index for the next edge
                             cell_edge_count += 1
@@ -334,15 +1082,18 @@ def jkr_neighbors_gpu(bin_locations, locations, radii, bins, bins_help, edge_hol
 
 
 @jit(nopython=True, parallel=True, cache=True)
-def jkr_neighbors_cpu(number_cells, bin_locations, locations, radii, bins, bins_help, edge_holder,
-                      if_edge, edge_count, max_neighbors):
+def jkr_neighbors_cpu(number_cells, bin_locations, locations, radii, bins, bins_help, bins_start, bins_table,
+                      edge_holder, edge_start, edge_count, fill):
     """ A just-in-time compiled function for the jkr_neighbors()
-        method that performs the actual calculations.
+        method that performs the actual calculations. This is called
+        once to count the edges of each cell and again to fill the
+        edge holder array with the edges. Each pair of cells is only
+        checked once by searching half of the surrounding bins.
     """
-    # loops over all cells, with the current cell index being the focus
-    for focus in prange(number_cells):
-        # get the starting index for writing to the edge holder array
-        start = focus * max_neighbors
+    # loops over the cells in the order they are sorted by bin, with the current cell index being the focus
+    for place in prange(number_cells):
+        # get the index of the cell
+        focus = bins[place]
 
         # holds the total amount of edges for a given cell
         cell_edge_count = 0
@@ -350,17 +1101,34 @@ def jkr_neighbors_cpu(number_cells, bin_locations, locations, radii, bins, bins_
         # get the bin location of the cell
         x, y, z = bin_locations[focus]
 
-        # go through the surrounding bins including the bin the cell is in
-        for i in range(-1, 2):
+        # go through the bin the cell is in and the 13 surrounding bins ahead of it, the pairs with the 13 bins behind
+        # it are checked by the cells in those bins
+        for i in range(0, 2):
             for j in range(-1, 2):
                 for k in range(-1, 2):
-                    # get the count of cells for the current bin
-                    bin_count = bins_help[x + i][y + j][z + k]
+                    # skip the bins behind the bin the cell is in
+                    if i == 0 and (j == -1 or (j == 0 and k == -1)):
+                        continue
+
+                    # find where the current bin is held, skipping it if there are no cells in it
+                    slot = find_bin(bins_table, x + i, y + j, z + k)
+                    if slot == -1:
+                        continue
+
+                    # get the count of cells for the current bin and where the bin begins in the sorted cells
+                    bin_count = bins_help[slot]
+                    bin_start = bins_start[slot]
+
+                    # in the bin the cell is in, only check the cells after it to prevent double counting edges
+                    if i == 0 and j == 0 and k == 0:
+                        bin_first = place + 1
+                    else:
+                        bin_first = bin_start
 
                     # go through the bin determining if a cell is a neighbor
-                    for l in range(bin_count):
+                    for l in range(bin_first, bin_start + bin_count):
                         # get the index of the current potential neighbor
-                        current = bins[x + i][y + j][z + k][l]
+                        current = bins[l]
 
                         # get the magnitude of the distance vector between the cell locations
                         mag = np.linalg.norm(locations[current] - locations[focus])
@@ -368,18 +1136,14 @@ def jkr_neighbors_cpu(number_cells, bin_locations, locations, radii, bins, bins_
                         # calculate the overlap of the cells
                         overlap = radii[current] + radii[focus] - mag
 
-                        # if there is 0 or more overlap and if the current cell has a higher index to prevent double
-                        # counting edges
-                        if overlap >= 0 and focus < current:
-                            # if less than the max edges, add the edge
-                            if cell_edge_count < max_neighbors:
-                                # get the index for the edge
-                                index = start + cell_edge_count
-
-                                # update the edge array and identify that this edge exists
-                                edge_holder[index][0] = focus
-                                edge_holder[index][1] = current
-                                if_edge[index] = 1
+                        # if there is 0 or more overlap
+                        if overlap >= 0:
+                            # if filling the edge holder, add the edge after the edges of the previous cells with the
+                            # lower index first
+                            if fill:
+                                index = edge_start[focus] + cell_edge_count
+                                edge_holder[index][0] = min(focus, current)
+                                edge_holder[index][1] = max(focus, current)
 
                             # increase the count of edges for a cell and the index for the next edge
                             cell_edge_count += 1
@@ -387,13 +1151,88 @@ def jkr_neighbors_cpu(number_cells, bin_locations, locations, radii, bins, bins_
         # update the array with number of edges for the cell
         edge_count[focus] = cell_edge_count
 
-    return edge_holder, if_edge, edge_count
+    return edge_holder, edge_count
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def jkr_neighbors_cpu_2d(number_cells, bin_locations, locations, radii, bins, bins_help, bins_start, bins_table,
+                         edge_holder, edge_start, edge_count, fill):
+    """ A version of jkr_neighbors_cpu() for a 2D space that only
+        searches the surrounding bins in the xy-plane and uses the
+        x and y distances between cells.
+    """
+    # loops over the cells in the order they are sorted by bin, with the current cell index being the focus
+    for place in prange(number_cells):
+        # get the index of the cell
+        focus = bins[place]
+
+        # holds the total amount of edges for a given cell
+        cell_edge_count = 0
+
+        # get the bin location of the cell, all cells are in the same z bin
+        x, y, z = bin_locations[focus]
+
+        # go through the bin the cell is in and the 4 surrounding bins ahead of it, the pairs with the 4 bins behind
+        # it are checked by the cells in those bins
+        for i in range(0, 2):
+            for j in range(-1, 2):
+                # skip the bins behind the bin the cell is in
+                if i == 0 and j == -1:
+                    continue
+
+                # find where the current bin is held, skipping it if there are no cells in it
+                slot = find_bin(bins_table, x + i, y + j, z)
+                if slot == -1:
+                    continue
+
+                # get the count of cells for the current bin and where the bin begins in the sorted cells
+                bin_count = bins_help[slot]
+                bin_start = bins_start[slot]
+
+                # in the bin the cell is in, only check the cells after it to prevent double counting edges
+                if i == 0 and j == 0:
+                    bin_first = place + 1
+                else:
+                    bin_first = bin_start
+
+                # go through the bin determining if a cell is a neighbor
+                for l in range(bin_first, bin_start + bin_count):
+                    # get the index of the current potential neighbor
+                    current = bins[l]
+
+                    # get the magnitude of the distance vector between the cell locations
+                    dx = locations[current][0] - locations[focus][0]
+                    dy = locations[current][1] - locations[focus][1]
+                    mag = math.sqrt(dx * dx + dy * dy)
+
+                    # calculate the overlap of the cells
+                    overlap = radii[current] + radii[focus] - mag
+
+                    # if there is 0 or more overlap
+                    if overlap >= 0:
+                        # if filling the edge holder, add the edge after the edges of the previous cells with the
+                        # lower index first
+                        if fill:
+                            index = edge_start[focus] + cell_edge_count
+                            edge_holder[index][0] = min(focus, current)
+                            edge_holder[index][1] = max(focus, current)
+
+                        # increase the count of edges for a cell and the index for the next edge
+                        cell_edge_count += 1
+
+        # update the array with number of edges for the cell
+        edge_count[focus] = cell_edge_count
+
+    return edge_holder, edge_count
 
 
 @cuda.jit
-def get_forces_gpu(jkr_edges, delete_edges, locations, radii, jkr_forces, poisson, youngs, adhesion_const):
+def get_forces_gpu(jkr_edges, delete_edges, locations, radii, edge_forces, poisson, youngs, adhesion_const):
     """ A just-in-time compiled cuda kernel for the get_forces()
-        method that performs the actual calculations.
+        method that performs the actual calculations, holding the
+        force of each edge such that gather_forces_gpu() can sum
+        the forces of each cell without threads writing to the
+        same cell.
     """
     # get the index in the edges array
     edge_index = cuda.grid(1)
@@ -443,9 +1282,9 @@ def get_forces_gpu(jkr_edges, delete_edges, locations, radii, jkr_forces, poisso
                 else:
                     normal = 0
 
-                # adds the adhesive force as a vector in opposite directions to each cell's force holder
-                jkr_forces[cell_1][i] += jkr_force * normal
-                jkr_forces[cell_2][i] -= jkr_force * normal
+                # hold the adhesive force as a vector, which is applied to cell_1 and in the opposite direction to
+                # cell_2 by gather_forces_gpu()
+                edge_forces[edge_index][i] = jkr_force * normal
 
         # remove the edge if the it fails to meet the criteria for distance, simulating that the bond is broken
         else:
@@ -453,10 +1292,13 @@ def get_forces_gpu(jkr_edges, delete_edges, locations, radii, jkr_forces, poisso
 
 
 @jit(nopython=True, parallel=True, cache=True)
-def get_forces_cpu(number_edges, jkr_edges, delete_edges, locations, radii, jkr_forces, poisson, youngs,
+def get_forces_cpu(number_edges, jkr_edges, delete_edges, locations, radii, edge_forces, poisson, youngs,
                    adhesion_const):
     """ A just-in-time compiled function for the get_forces()
-        method that performs the actual calculations.
+        method that performs the actual calculations, holding the
+        force of each edge such that gather_forces_cpu() can sum
+        the forces of each cell without threads writing to the
+        same cell.
     """
     # go through the edges array
     for edge_index in prange(number_edges):
@@ -489,21 +1331,142 @@ def get_forces_cpu(number_edges, jkr_edges, delete_edges, locations, radii, jkr_
             # convert from the nondimensionalized force to find the JKR force
             jkr_force = f * math.pi * adhesion_const * r_hat
 
-            # if the magnitude is 0 use the zero vector, otherwise find the normalized vector for each axis. numba's
-            # jit prefers a reduction instead of generating a new normalized array
-            normal = np.array([0.0, 0.0, 0.0])
+            # if the magnitude is 0 use the zero vector, otherwise hold the adhesive force as a vector, which is
+            # applied to cell_1 and in the opposite direction to cell_2 by gather_forces_cpu()
             if mag != 0:
-                normal += vector / mag
+                for i in range(3):
+                    edge_forces[edge_index][i] = jkr_force * (vector[i] / mag)
+
+        # remove the edge if the it fails to meet the criteria for distance, simulating that the bond is broken
+        else:
+            delete_edges[edge_index] = 1
 
-            # adds the adhesive force as a vector in opposite directions to each cell's force holder
-            jkr_forces[cell_1] += jkr_force * normal
-            jkr_forces[cell_2] -= jkr_force * normal
+    return edge_forces, delete_edges
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def get_forces_cpu_2d(number_edges, jkr_edges, delete_edges, locations, radii, edge_forces, poisson, youngs,
+                      adhesion_const):
+    """ A version of get_forces_cpu() for a 2D space that only
+        uses the x and y components of the vectors between cells.
+    """
+    # get two values used for JKR calculation
+    e_hat = (((1 - poisson ** 2) / youngs) + ((1 - poisson ** 2) / youngs)) ** -1
+
+    # go through the edges array
+    for edge_index in prange(number_edges):
+        # get the cell indices of the edge
+        cell_1 = jkr_edges[edge_index][0]
+        cell_2 = jkr_edges[edge_index][1]
+
+        # get the vector between the centers of the cells and the magnitude of this vector
+        dx = locations[cell_1][0] - locations[cell_2][0]
+        dy = locations[cell_1][1] - locations[cell_2][1]
+        mag = math.sqrt(dx * dx + dy * dy)
+
+        # get the overlap of the cells
+        overlap = radii[cell_1] + radii[cell_2] - mag
+
+        # get the value used for JKR calculation
+        r_hat = ((1 / radii[cell_1]) + (1 / radii[cell_2])) ** -1
+
+        # value used to calculate the max adhesive distance after bond has been already formed
+        overlap_ = (((math.pi * adhesion_const) / e_hat) ** (2 / 3)) * (r_hat ** (1 / 3))
+
+        # get the nondimensionalized overlap
+        d = overlap / overlap_
+
+        # check to see if the cells will have a force interaction based on the nondimensionalized distance
+        if d > -0.360562:
+            # plug the value of d into polynomial approximation for nondimensionalized force
+            f = (-0.0204 * d ** 3) + (0.4942 * d ** 2) + (1.0801 * d) - 1.324
+
+            # convert from the nondimensionalized force to find the JKR force
+            jkr_force = f * math.pi * adhesion_const * r_hat
+
+            # if the magnitude is 0 use the zero vector, otherwise hold the adhesive force as a vector, which is
+            # applied to cell_1 and in the opposite direction to cell_2 by gather_forces_cpu()
+            if mag != 0:
+                edge_forces[edge_index][0] = jkr_force * dx / mag
+                edge_forces[edge_index][1] = jkr_force * dy / mag
 
         # remove the edge if the it fails to meet the criteria for distance, simulating that the bond is broken
         else:
             delete_edges[edge_index] = 1
 
-    return jkr_forces, delete_edges
+    return edge_forces, delete_edges
+
+
+@jit(nopython=True, cache=True)
+def bond_incidence(number_cells, jkr_edges):
+    """ Returns the edges of each cell as CSR arrays, such that the
+        edges of cell i are incident[incident_start[i]:incident_start[i + 1]]
+        in the order of the edges array. Each value is 2 * edge index for
+        the first cell of the edge and 2 * edge index + 1 for the second.
+    """
+    # count the edges of each cell and get where the edges of each cell begin
+    incident_start = np.zeros(number_cells + 1, dtype=np.int64)
+    for edge_index in range(jkr_edges.shape[0]):
+        incident_start[jkr_edges[edge_index][0] + 1] += 1
+        incident_start[jkr_edges[edge_index][1] + 1] += 1
+    for i in range(number_cells):
+        incident_start[i + 1] += incident_start[i]
+
+    # place the edges of each cell in order, using a copy of the starts as the next open position of each cell
+    incident = np.empty(2 * jkr_edges.shape[0], dtype=np.int64)
+    position = incident_start[:-1].copy()
+    for edge_index in range(jkr_edges.shape[0]):
+        cell_1 = jkr_edges[edge_index][0]
+        cell_2 = jkr_edges[edge_index][1]
+        incident[position[cell_1]] = 2 * edge_index
+        incident[position[cell_2]] = 2 * edge_index + 1
+        position[cell_1] += 1
+        position[cell_2] += 1
+
+    return incident_start, incident
+
+
+@cuda.jit
+def gather_forces_gpu(incident_start, incident, edge_forces, jkr_forces):
+    """ A just-in-time compiled cuda kernel for the get_forces()
+        method that sums the forces of the edges of each cell.
+    """
+    # get the index of the cell
+    index = cuda.grid(1)
+
+    # double check that index is within the cells, as the cell arrays may already hold cells being added
+    if index < incident_start.shape[0] - 1:
+        # go through the edges of the cell in order
+        for i in range(incident_start[index], incident_start[index + 1]):
+            edge_index = incident[i] // 2
+
+            # add the force of the edge if the cell is the first of the edge, otherwise subtract it
+            for j in range(3):
+                if incident[i] % 2 == 0:
+                    jkr_forces[index][j] += edge_forces[edge_index][j]
+                else:
+                    jkr_forces[index][j] -= edge_forces[edge_index][j]
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def gather_forces_cpu(number_cells, incident_start, incident, edge_forces, jkr_forces):
+    """ Sums the forces of the edges of each cell for the get_forces()
+        method. Each cell adds its edges in the same order no matter
+        the number of threads, so the forces are reproducible.
+    """
+    for index in prange(number_cells):
+        # go through the edges of the cell in order
+        for i in range(incident_start[index], incident_start[index + 1]):
+            edge_index = incident[i] // 2
+
+            # add the force of the edge if the cell is the first of the edge, otherwise subtract it
+            for j in range(3):
+                if incident[i] % 2 == 0:
+                    jkr_forces[index][j] += edge_forces[edge_index][j]
+                else:
+                    jkr_forces[index][j] -= edge_forces[edge_index][j]
+
+    return jkr_forces
 
 
 @cuda.jit
@@ -565,9 +1528,307 @@ def apply_forces_cpu(number_cells, jkr_force, motility_force, locations, radii,
     return locations
 
 
+@jit(nopython=True, parallel=True, cache=True)
+def apply_forces_cpu_2d(number_cells, jkr_force, motility_force, locations, radii, viscosity, size, move_dt):
+    """ A version of apply_forces_cpu() for a 2D space that only
+        moves the cells in the xy-plane.
+    """
+    # loop over all cells
+    for i in prange(number_cells):
+        # stokes law for velocity based on force and fluid viscosity (friction)
+        stokes_friction = 6 * math.pi * viscosity * radii[i]
+
+        # loop over the x and y directions of space
+        for j in range(0, 2):
+            # update the velocity of the cell based on stokes and get the new location
+            velocity = (motility_force[i][j] + jkr_force[i][j]) / stokes_friction
+            new_location = locations[i][j] + velocity * move_dt
+
+            # check if new location is in the space, if not return it to the space limits
+            if new_location > size[j]:
+                locations[i][j] = size[j]
+            elif new_location < 0:
+                locations[i][j] = 0
+            else:
+                locations[i][j] = new_location
+
+    return locations
+
+
+@jit(nopython=True, cache=True)
+def candidate_pairs(locations, distance, is_2d):
+    """ Returns the pairs of cells within the distance using the
+        bins, a compiled version of neighbor_edges() used by
+        relax_mechanics_jit().
+    """
+    number_cells = locations.shape[0]
+
+    # assign the cells to bins with the distance as the bin width, offset by 1 like assign_bins()
+    bin_locations = np.floor_divide(locations, distance).astype(np.int64) + 1
+    bins, bins_help, bins_start, bins_table = assign_bins_jit(bin_locations)
+
+    # call the search once to count the edges of each cell
+    edge_holder = np.zeros((0, 2), dtype=np.int64)
+    edge_start = np.zeros(number_cells, dtype=np.int64)
+    edge_count = np.zeros(number_cells, dtype=np.int64)
+    if is_2d:
+        edge_holder, edge_count = get_neighbors_cpu_2d(number_cells, bin_locations, locations, bins, bins_help,
+                                                       bins_start, bins_table, distance, edge_holder, edge_start,
+                                                       edge_count, False)
+    else:
+        edge_holder, edge_count = get_neighbors_cpu(number_cells, bin_locations, locations, bins, bins_help,
+                                                    bins_start, bins_table, distance, edge_holder, edge_start,
+                                                    edge_count, False)
+
+    # get where the edges of each cell begin and make an edge holder that fits all of the edges
+    edge_start = np.cumsum(edge_count) - edge_count
+    edge_holder = np.empty((np.sum(edge_count), 2), dtype=np.int64)
+
+    # call the search again to fill the edge holder
+    if is_2d:
+        edge_holder, edge_count = get_neighbors_cpu_2d(number_cells, bin_locations, locations, bins, bins_help,
+                                                       bins_start, bins_table, distance, edge_holder, edge_start,
+                                                       edge_count, True)
+    else:
+        edge_holder, edge_count = get_neighbors_cpu(number_cells, bin_locations, locations, bins, bins_help,
+                                                    bins_start, bins_table, distance, edge_holder, edge_start,
+                                                    edge_count, True)
+
+    return edge_holder
+
+
+@jit(nopython=True, cache=True)
+def merge_contacts(bonds, pairs, locations, radii, awake, wake):
+    """ Returns the bonds merged with the pairs of cells that have
+        0 or more overlap, each held once and sorted like the edges
+        of BondGraph. Pairs of two sleeping cells are skipped, and a
+        new contact between an awake and a sleeping cell marks both
+        cells in the wake array.
+    """
+    # pack the bonds into single integer keys like BondGraph.add_edges()
+    keys = np.empty(bonds.shape[0] + pairs.shape[0], dtype=np.int64)
+    for i in range(bonds.shape[0]):
+        keys[i] = (bonds[i][0] << 32) | bonds[i][1]
+    number_bonds = number_keys = bonds.shape[0]
+
+    # add the keys of the pairs with 0 or more overlap
+    for i in range(pairs.shape[0]):
+        cell_1, cell_2 = pairs[i][0], pairs[i][1]
+
+        # sleeping cells don't move, so two sleeping cells can't make a new contact
+        if not (awake[cell_1] or awake[cell_2]):
+            continue
+
+        dx = locations[cell_1][0] - locations[cell_2][0]
+        dy = locations[cell_1][1] - locations[cell_2][1]
+        dz = locations[cell_1][2] - locations[cell_2][2]
+        mag = math.sqrt(dx * dx + dy * dy + dz * dz)
+        if radii[cell_1] + radii[cell_2] - mag >= 0:
+            keys[number_keys] = (min(cell_1, cell_2) << 32) | max(cell_1, cell_2)
+
+            # if one of the cells is sleeping, wake it if the contact isn't already a bond
+            if not (awake[cell_1] and awake[cell_2]):
+                place = np.searchsorted(keys[:number_bonds], keys[number_keys])
+                if place == number_bonds or keys[place] != keys[number_keys]:
+                    wake[cell_1] = wake[cell_2] = True
+
+            number_keys += 1
+
+    # keep each key once and unpack the keys into bonds
+    keys = np.unique(keys[:number_keys])
+    merged = np.empty((keys.shape[0], 2), dtype=np.int64)
+    merged[:, 0] = keys >> 32
+    merged[:, 1] = keys & 0xFFFFFFFF
+
+    return merged
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def max_speed_cpu(number_cells, moving, jkr_force, motility_force, radii, viscosity):
+    """ Returns the speed of the fastest moving cell from the forces
+        on the cells, using the stokes friction like apply_forces_cpu().
+    """
+    speed = 0.0
+    for i in prange(number_cells):
+        # skip any sleeping cells
+        if not moving[i]:
+            continue
+
+        # stokes law for velocity based on force and fluid viscosity (friction)
+        stokes_friction = 6 * math.pi * viscosity * radii[i]
+
+        # get the magnitude of the velocity
+        total = 0.0
+        for j in range(3):
+            total += ((motility_force[i][j] + jkr_force[i][j]) / stokes_friction) ** 2
+        speed = max(speed, math.sqrt(total))
+
+    return speed
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def apply_forces_sleep_cpu(number_cells, awake, wake, jkr_force, motility_force, locations, radii, viscosity, size,
+                           move_dt, sleep_counters, sleep_force, sleep_distance, is_2d):
+    """ A version of apply_forces_cpu() for relax_mechanics_jit() that
+        only moves the awake cells. An awake cell counts the sub-steps
+        in a row it has had a net force and movement below the sleep
+        thresholds, while a sleeping cell is woken (its count is reset)
+        if the force on it is above the threshold or it's marked to wake.
+    """
+    # the number of directions the cells move in
+    dimensions = 2 if is_2d else 3
+
+    # loop over all cells
+    for i in prange(number_cells):
+        # get the magnitude of the net force on the cell
+        total = 0.0
+        for j in range(3):
+            total += (motility_force[i][j] + jkr_force[i][j]) ** 2
+        force = math.sqrt(total)
+
+        if awake[i]:
+            # stokes law for velocity based on force and fluid viscosity (friction)
+            stokes_friction = 6 * math.pi * viscosity * radii[i]
+
+            # go through the directions of space, keeping track of how far the cell moves
+            moved = 0.0
+            for j in range(dimensions):
+                # update the velocity of the cell based on stokes and get the new location
+                velocity = (motility_force[i][j] + jkr_force[i][j]) / stokes_friction
+                new_location = locations[i][j] + velocity * move_dt
+
+                # check if new location is in the space, if not return it to the space limits
+                if new_location > size[j]:
+                    new_location = size[j]
+                elif new_location < 0:
+                    new_location = 0
+                moved += (new_location - locations[i][j]) ** 2
+                locations[i][j] = new_location
+
+            # count the sub-step towards sleeping if the cell is nearly still, otherwise restart the count
+            if force < sleep_force and math.sqrt(moved) < sleep_distance:
+                sleep_counters[i] += 1
+            else:
+                sleep_counters[i] = 0
+
+        # wake a sleeping cell, which moves from the next sub-step on
+        elif wake[i] or force > sleep_force:
+            sleep_counters[i] = 0
+
+    return locations, sleep_counters
+
+
+@jit(nopython=True, cache=True)
+def relax_mechanics_jit(number_substeps, number_cells, locations, radii, motility_forces, bonds, pairs,
+                        pair_locations, rebuild, reach, skin, size, viscosity, move_dt, poisson, youngs,
+                        adhesion_const, is_2d, adaptive, move_tolerance, min_move_dt, rest_speed, sleep_counters,
+                        sleep_steps, sleep_force, sleep_distance):
+    """ A just-in-time compiled function for the relax_mechanics()
+        method that runs all of the sub-steps of contact detection,
+        JKR bond update, force calculation, and movement, using the
+        same compiled functions as the separate methods. If adaptive,
+        the sub-steps vary in length to cover the same time. If
+        sleep_steps is above 0, cells that have been nearly still for
+        that many sub-steps sleep, skipping the bonds between sleeping
+        cells and the movement of sleeping cells.
+    """
+    # the force of each cell, reset to zero after each movement
+    jkr_forces = np.zeros(locations.shape, dtype=np.float64)
+
+    # the cells that are awake at the start of a sub-step and the sleeping cells to wake
+    awake = np.ones(number_cells, dtype=np.bool_)
+    wake = np.zeros(number_cells, dtype=np.bool_)
+
+    # whether new candidate pairs were found and the number of sub-steps taken
+    rebuilt = False
+    substeps = 0
+
+    # the time (seconds) left to cover with adaptive sub-steps
+    time_left = number_substeps * move_dt
+
+    while (adaptive and time_left > 0) or (not adaptive and substeps < number_substeps):
+        # get the awake cells, though all cells are awake for the first sub-step such that the full forces on the
+        # sleeping cells are checked after any growth, division, death, or change in motility since the last step
+        if sleep_steps > 0 and substeps > 0:
+            awake[:] = sleep_counters[:number_cells] < sleep_steps
+            wake[:] = False
+        # check whether a cell has moved more than half of the skin since the candidate pairs were found
+        if not rebuild:
+            displacement = 0.0
+            for i in range(number_cells):
+                moved = 0.0
+                for j in range(3):
+                    moved += (locations[i][j] - pair_locations[i][j]) ** 2
+                displacement = max(displacement, moved)
+            rebuild = math.sqrt(displacement) > skin / 2
+
+        # find new candidate pairs padded by the skin if the held pairs may be missing an interaction
+        if rebuild:
+            pairs = candidate_pairs(locations[:number_cells], reach + skin, is_2d)
+            pair_locations = locations[:number_cells].copy()
+            rebuild = False
+            rebuilt = True
+
+        # merge the pairs with 0 or more overlap into the bonds
+        bonds = merge_contacts(bonds, pairs, locations, radii, awake, wake)
+
+        # get the bonds with at least one awake cell, as the bonds between sleeping cells don't change
+        active = np.flatnonzero(awake[bonds[:, 0]] | awake[bonds[:, 1]])
+        active_bonds = bonds[active]
+
+        # get the force of each bond, sum the forces of each cell, and remove any broken bonds
+        number_edges = active_bonds.shape[0]
+        if number_edges > 0:
+            edge_forces = np.zeros((number_edges, 3), dtype=np.float64)
+            delete_edges = np.zeros(number_edges, dtype=np.bool_)
+            incident_start, incident = bond_incidence(number_cells, active_bonds)
+            if is_2d:
+                edge_forces, delete_edges = get_forces_cpu_2d(number_edges, active_bonds, delete_edges, locations,
+                                                              radii, edge_forces, poisson, youngs, adhesion_const)
+            else:
+                edge_forces, delete_edges = get_forces_cpu(number_edges, active_bonds, delete_edges, locations,
+                                                           radii, edge_forces, poisson, youngs, adhesion_const)
+            jkr_forces = gather_forces_cpu(number_cells, incident_start, incident, edge_forces, jkr_forces)
+            keep = np.ones(bonds.shape[0], dtype=np.bool_)
+            keep[active[delete_edges]] = False
+            bonds = bonds[keep]
+
+        # if adaptive, stop once the cells are at rest, otherwise make the sub-step as long as possible without the
+        # fastest cell moving more than the tolerance, while not shorter than the min or longer than the time left
+        if adaptive:
+            speed = max_speed_cpu(number_cells, awake, jkr_forces, motility_forces, radii, viscosity)
+            if speed < rest_speed:
+                jkr_forces[:, :] = 0
+                break
+            if speed * time_left <= move_tolerance:
+                dt = time_left
+            else:
+                dt = min(max(move_tolerance / speed, min_move_dt), time_left)
+        else:
+            dt = move_dt
+
+        # move the cells and reset the forces back to zero, only moving the awake cells if using sleep
+        if sleep_steps > 0:
+            locations, sleep_counters = apply_forces_sleep_cpu(number_cells, awake, wake, jkr_forces,
+                                                               motility_forces, locations, radii, viscosity, size,
+                                                               dt, sleep_counters, sleep_force, sleep_distance,
+                                                               is_2d)
+        elif is_2d:
+            locations = apply_forces_cpu_2d(number_cells, jkr_forces, motility_forces, locations, radii, viscosity,
+                                            size, dt)
+        else:
+            locations = apply_forces_cpu(number_cells, jkr_forces, motility_forces, locations, radii, viscosity,
+                                         size, dt)
+        jkr_forces[:, :] = 0
+        time_left -= dt
+        substeps += 1
+
+    return locations, bonds, pairs, pair_locations, rebuilt, substeps, sleep_counters
+
+
 @cuda.jit
-def nearest_gpu(bin_locations, locations, bins, bins_help, distance, if_diff, gata6, nanog, nearest_gata6,
-                nearest_nanog, nearest_diff):
+def nearest_gpu(bin_locations, locations, bins, bins_help, bins_start, bins_table, distance, if_diff, gata6, nanog,
+                nearest_gata6, nearest_nanog, nearest_diff):
     """ A just-in-time compiled cuda kernel for the nearest()
         method that performs the actual calculations.
     """
@@ -575,7 +1836,7 @@ def nearest_gpu(bin_locations, locations, bins, bins_help, distance, if_diff, ga
     focus = cuda.grid(1)
 
     # double check that the index is within the array
-    if focus < locations.shape[0]:
+    if focus < bin_locations.shape[0]:
         # get the bin location of the cell
         x, y, z = bin_locations[focus]
 
@@ -589,13 +1850,19 @@ def nearest_gpu(bin_locations, locations, bins, bins_help, distance, if_diff, ga
         for i in range(-1, 2):
             for j in range(-1, 2):
                 for k in range(-1, 2):
-                    # get the count of cells for the current bin
-                    bin_count = bins_help[x + i][y + j][z + k]
+                    # find where the current bin is held, skipping it if there are no cells in it
+                    slot = find_bin_gpu(bins_table, x + i, y + j, z + k)
+                    if slot == -1:
+                        continue
+
+                    # get the count of cells for the current bin and where the bin begins in the sorted cells
+                    bin_count = bins_help[slot]
+                    bin_start = bins_start[slot]
 
                     # go through the bin
-                    for l in range(bin_count):
+                    for l in range(bin_start, bin_start + bin_count):
                         # get the index of the current potential nearest cell
-                        current = bins[x + i][y + j][z + k][l]
+                        current = bins[l]
 
                         # get the magnitude of the distance vector between the cells
                         mag = magnitude(locations[focus], locations[current])
@@ -630,66 +1897,135 @@ def nearest_gpu(bin_locations, locations, bins, bins_help, distance, if_diff, ga
 
 
 @jit(nopython=True, parallel=True, cache=True)
-def nearest_cpu(number_cells, bin_locations, locations, bins, bins_help, distance, if_diff, gata6, nanog, nearest_gata6,
-                nearest_nanog, nearest_diff):
-    """ A just-in-time compiled function for the nearest()
-        method that performs the actual calculations.
+def nearest_type_cpu(number_cells, bin_locations, locations, indices, bins, bins_help, bins_start, bins_table, width,
+                     distance, nearest):
+    """ A just-in-time compiled function for the nearest() method that
+        finds the nearest cell of a single type for each cell. The bins
+        only hold cells of the type and are searched in rings of bins
+        around the cell, stopping once no closer cell can remain.
     """
+    # get the number of rings of bins needed to cover the search radius
+    rings = int(math.ceil(distance / width))
+
     # loop over all cells
     for focus in prange(number_cells):
         # get the bin location of the cell
         x, y, z = bin_locations[focus]
 
-        # initialize the nearest indices with -1 which will be interpreted as no cell by the motility function
-        nearest_gata6_index, nearest_nanog_index, nearest_diff_index = -1, -1, -1
+        # initialize the nearest index with -1 which will be interpreted as no cell by the motility function
+        nearest_index = -1
 
-        # initialize the distance for each with double the search radius to provide a starting point
-        nearest_gata6_dist, nearest_nanog_dist, nearest_diff_dist = distance * 2, distance * 2, distance * 2
+        # initialize the distance with double the search radius to provide a starting point
+        nearest_dist = distance * 2
 
-        # go through the surrounding bins including the bin the cell is in
-        for i in range(-1, 2):
-            for j in range(-1, 2):
-                for k in range(-1, 2):
-                    # get the count of cells for the current bin
-                    bin_count = bins_help[x + i][y + j][z + k]
+        # go through the rings of bins, starting with the bin the cell is in
+        for ring in range(rings + 1):
+            for i in range(-ring, ring + 1):
+                for j in range(-ring, ring + 1):
+                    # if the x and y offsets are inside the ring, only the bins above and below are part of the ring
+                    if ring == 0 or abs(i) == ring or abs(j) == ring:
+                        step = 1
+                    else:
+                        step = 2 * ring
+
+                    for k in range(-ring, ring + 1, step):
+                        # find where the current bin is held, skipping it if there are no cells in it
+                        slot = find_bin(bins_table, x + i, y + j, z + k)
+                        if slot == -1:
+                            continue
+
+                        # get the count of cells for the current bin and where the bin begins in the sorted cells
+                        bin_count = bins_help[slot]
+                        bin_start = bins_start[slot]
+
+                        # go through the bin
+                        for l in range(bin_start, bin_start + bin_count):
+                            # get the index of the current potential nearest cell
+                            current = indices[bins[l]]
+
+                            # get the magnitude of the distance vector between the cells
+                            mag = np.linalg.norm(locations[current] - locations[focus])
+
+                            # if the cell is within the search radius, not the same cell, and closer than the last
+                            # cell, update the distance and index
+                            if mag <= distance and focus != current and mag < nearest_dist:
+                                nearest_index = current
+                                nearest_dist = mag
+
+            # any cell in the bins outside of this ring is at least this far away, so stop if one is closer
+            if nearest_dist <= ring * width:
+                break
+
+        # update the array
+        nearest[focus] = nearest_index
+
+    return nearest
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def nearest_type_cpu_2d(number_cells, bin_locations, locations, indices, bins, bins_help, bins_start, bins_table,
+                        width, distance, nearest):
+    """ A version of nearest_type_cpu() for a 2D space that only
+        searches rings of bins in the xy-plane and uses the x and y
+        distances between cells.
+    """
+    # get the number of rings of bins needed to cover the search radius
+    rings = int(math.ceil(distance / width))
+
+    # loop over all cells
+    for focus in prange(number_cells):
+        # get the bin location of the cell, all cells are in the same z bin
+        x, y, z = bin_locations[focus]
+
+        # initialize the nearest index with -1 which will be interpreted as no cell by the motility function
+        nearest_index = -1
+
+        # initialize the distance with double the search radius to provide a starting point
+        nearest_dist = distance * 2
+
+        # go through the rings of bins, starting with the bin the cell is in
+        for ring in range(rings + 1):
+            for i in range(-ring, ring + 1):
+                # if the x offset is inside the ring, only the bins before and after are part of the ring
+                if ring == 0 or abs(i) == ring:
+                    step = 1
+                else:
+                    step = 2 * ring
+
+                for j in range(-ring, ring + 1, step):
+                    # find where the current bin is held, skipping it if there are no cells in it
+                    slot = find_bin(bins_table, x + i, y + j, z)
+                    if slot == -1:
+                        continue
+
+                    # get the count of cells for the current bin and where the bin begins in the sorted cells
+                    bin_count = bins_help[slot]
+                    bin_start = bins_start[slot]
 
                     # go through the bin
-                    for l in range(bin_count):
+                    for l in range(bin_start, bin_start + bin_count):
                         # get the index of the current potential nearest cell
-                        current = bins[x + i][y + j][z + k][l]
+                        current = indices[bins[l]]
 
                         # get the magnitude of the distance vector between the cells
-                        mag = np.linalg.norm(locations[current] - locations[focus])
+                        dx = locations[current][0] - locations[focus][0]
+                        dy = locations[current][1] - locations[focus][1]
+                        mag = math.sqrt(dx * dx + dy * dy)
 
-                        # check to see if the current cell is within the search radius and not the same cell
-                        if mag <= distance and focus != current:
-                            # if the current cell is differentiated
-                            if if_diff[current]:
-                                # if it's closer than the last cell, update the distance and index
-                                if mag < nearest_diff_dist:
-                                    nearest_diff_index = current
-                                    nearest_diff_dist = mag
-
-                            # if the current cell is gata6 high
-                            elif gata6[current] > nanog[current]:
-                                # if it's closer than the last cell, update the distance and index
-                                if mag < nearest_gata6_dist:
-                                    nearest_gata6_index = current
-                                    nearest_gata6_dist = mag
+                        # if the cell is within the search radius, not the same cell, and closer than the last cell,
+                        # update the distance and index
+                        if mag <= distance and focus != current and mag < nearest_dist:
+                            nearest_index = current
+                            nearest_dist = mag
 
-                            # if the current cell is nanog high
-                            elif gata6[current] < nanog[current]:
-                                # if it's closer than the last cell, update the distance and index
-                                if mag < nearest_nanog_dist:
-                                    nearest_nanog_index = current
-                                    nearest_nanog_dist = mag
+            # any cell in the bins outside of this ring is at least this far away, so stop if one is closer
+            if nearest_dist <= ring * width:
+                break
 
-        # update the arrays
-        nearest_gata6[focus] = nearest_gata6_index
-        nearest_nanog[focus] = nearest_nanog_index
-        nearest_diff[focus] = nearest_diff_index
+        # update the array
+        nearest[focus] = nearest_index
 
-    return nearest_gata6, nearest_nanog, nearest_diff
+    return nearest
 
 
 @jit(nopython=True, cache=True)
@@ -727,6 +2063,189 @@ def update_diffusion_jit(base, steps, diffuse_dt, last_dt, diffuse_const, spat_r
     return base[1:-1, 1:-1]
 
 
+def fds_functions(x1, x2, x3, x4, x5, field):
+    """ The default update functions of the finite dynamical system,
+        which return the new FGFR, ERK, GATA6, and NANOG values from
+        the FGF4, FGFR, ERK, GATA6, and NANOG values. These are only
+        evaluated on arrays of every combination of values to make
+        the lookup table, see make_fds_table().
+    """
+    # if the FDS is boolean
+    if field == 2:
+        # update boolean values based on FDS functions
+        new_fgfr = (x1 * x4) % 2
+        new_erk = x2 % 2
+        new_gata6 = (1 + x5 + x5 * x4) % 2
+        new_nanog = ((x3 + 1) * (x4 + 1)) % 2
+
+    # if the FDS is ternary
+    elif field == 3:
+        # update ternary values based on FDS functions
+        new_fgfr = (x1 * x4 * ((2*x1 + 1) * (2*x4 + 1) + x1 * x4)) % 3
+        new_erk = x2 % 3
+        new_gata6 = ((x4**2) * (x5 + 1) + (x5**2) * (x4 + 1) + 2*x5 + 1) % 3
+        new_nanog = (x5**2 + x5 * (x5 + 1) * (x3 * (2*x4**2 + 2*x3 + 1) + x4*(2*x3**2 + 2*x4 + 1)) +
+                     (2*x3**2 + 1) * (2*x4**2 + 1)) % 3
+
+    # otherwise there are no default functions for the field
+    else:
+        raise Exception("No default FDS functions for this field, specify fds_functions in parameters.py")
+
+    return new_fgfr, new_erk, new_gata6, new_nanog
+
+
+def make_fds_table(field, functions=None):
+    """ Precompiles the update functions of the finite dynamical
+        system into a lookup table, where the new FGFR, ERK, GATA6,
+        and NANOG values are table[FGF4, FGFR, ERK, GATA6, NANOG].
+        The functions are called once with arrays of every
+        combination of values, see fds_functions().
+    """
+    # use the default boolean or ternary functions if none are specified
+    if functions is None:
+        functions = fds_functions
+
+    # get every combination of the five FDS values, each an array with a dimension for each value
+    values = np.indices((field,) * 5)
+
+    # evaluate the functions on every combination, making sure the new values are in the field
+    table = np.stack(functions(*values, field), axis=-1) % field
+    return table.astype(int)
+
+
+@jit(nopython=True, cache=True)
+def update_pathway_jit(number_cells, indices, gradient, fgfr, erk, gata6, nanog, fds_counters, fds_thresh,
+                       fds_table, thresholds):
+    """ A just-in-time compiled function for the cell_pathway() method
+        that goes through the cells in order, as each cell adds FGF4 to
+        the gradient and takes up FGF4 added by the cells before it.
+    """
+    for index in range(number_cells):
+        # get the nearest diffusion point of the cell
+        x, y, z = indices[index][0], indices[index][1], indices[index][2]
+
+        # add FGF4 to the gradient based on the cell's value of NANOG
+        if nanog[index] > 0:
+            gradient[x][y][z] += nanog[index]
+
+        # get an FGF4 value for the FDS from the number of concentration thresholds met
+        fgf4_fds = 0
+        for threshold in thresholds:
+            if gradient[x][y][z] >= threshold:
+                fgf4_fds += 1
+
+        # if updating the FDS values this step
+        if fds_counters[index] % fds_thresh == 0:
+            # look up the new FDS values of the cell from the current values
+            new_values = fds_table[fgf4_fds, fgfr[index], erk[index], gata6[index], nanog[index]]
+
+            # if the amount of FGFR has increased, subtract that much FGF4 from the gradient
+            fgfr_change = new_values[0] - fgfr[index]
+            if fgfr_change > 0:
+                gradient[x][y][z] -= fgfr_change
+
+            # update the FDS values of the cell
+            fgfr[index] = new_values[0]
+            erk[index] = new_values[1]
+            gata6[index] = new_values[2]
+            nanog[index] = new_values[3]
+
+        # increase the finite dynamical system counter
+        fds_counters[index] += 1
+
+    return gradient, fgfr, erk, gata6, nanog, fds_counters
+
+
+@jit(nopython=True, cache=True)
+def cell_random(seed, index, draw):
+    """ Returns a random number in [0, 1) for a draw of a cell by
+        hashing the seed, cell index, and draw number (splitmix64),
+        such that the numbers don't depend on the thread or the
+        order that the cells are handled.
+    """
+    # combine the seed, cell index, and draw number into a single 64-bit integer
+    z = np.uint64(seed) + (np.uint64(index) * np.uint64(4) + np.uint64(draw) + np.uint64(1)) * \
+        np.uint64(0x9E3779B97F4A7C15)
+
+    # mix the bits of the integer
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    z = z ^ (z >> np.uint64(31))
+
+    # use the top 53 bits as the fraction of a double
+    return (z >> np.uint64(11)) * (1.0 / 9007199254740992.0)
+
+
+@jit(nopython=True, cache=True)
+def cell_random_vector(seed, index, is_2d):
+    """ A version of random_vector() for compiled functions, using
+        cell_random() for the random angles of a cell.
+    """
+    # random angle on the cell
+    theta = cell_random(seed, index, 0) * 2 * math.pi
+
+    # 2D vector: [x, y, 0]
+    if is_2d:
+        return math.cos(theta), math.sin(theta), 0.0
+
+    # 3D vector: [x, y, z]
+    else:
+        phi = cell_random(seed, index, 1) * 2 * math.pi
+        radius = math.cos(phi)
+        return radius * math.cos(theta), radius * math.sin(theta), math.sin(phi)
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def eunbi_motility_cpu(number_cells, locations, motion, degrees, if_diff, if_gata6, if_nanog, nearest_gata6,
+                       nearest_nanog, nearest_diff, motility_forces, motility_force, seed, is_2d):
+    """ A just-in-time compiled function for the eunbi_motility()
+        method that performs the actual calculations.
+    """
+    for index in prange(number_cells):
+        # only calculate motility forces if the cell is actively moving and not surrounded by 6 or more other cells
+        if motion[index] and degrees[index] < 6:
+            # get the random vector of the cell
+            random_x, random_y, random_z = cell_random_vector(seed, index, is_2d)
+
+            # find a cell to move toward (positive direction) or away from (negative direction), -1 if moving randomly
+            target, direction = -1, 0.0
+
+            # if differentiated, move away from a nanog high cell nearby
+            if if_diff[index]:
+                if nearest_nanog[index] != -1:
+                    target, direction = nearest_nanog[index], -0.8
+
+            # if the cell is gata6 high and nanog low, move toward a differentiated cell nearby
+            elif if_gata6[index]:
+                if nearest_diff[index] != -1:
+                    target, direction = nearest_diff[index], 0.8
+
+            # if the cell is nanog high and gata6 low, move toward a nanog high cell or away from a gata6 high cell
+            elif if_nanog[index]:
+                if nearest_nanog[index] != -1:
+                    target, direction = nearest_nanog[index], 0.8
+                elif nearest_gata6[index] != -1:
+                    target, direction = nearest_gata6[index], -0.8
+
+            # if there's no cell to move toward or away from, move randomly
+            if target == -1:
+                motility_forces[index][0] += random_x * motility_force
+                motility_forces[index][1] += random_y * motility_force
+                motility_forces[index][2] += random_z * motility_force
+
+            # otherwise get the normal vector to the cell and combine it with the random vector
+            else:
+                vector = locations[target] - locations[index]
+                mag = np.linalg.norm(vector)
+                if mag != 0:
+                    vector /= mag
+                motility_forces[index][0] += (vector[0] * direction + random_x * 0.2) * motility_force
+                motility_forces[index][1] += (vector[1] * direction + random_y * 0.2) * motility_force
+                motility_forces[index][2] += (vector[2] * direction + random_z * 0.2) * motility_force
+
+    return motility_forces
+
+
 def get_concentration(simulation, gradient_name, index):
     """ Get the concentration of a gradient for a cell's
         location. Currently this uses the nearest method.
@@ -804,6 +2323,33 @@ def adjust_morphogens(simulation, gradient_name, index, amount, mode):
         raise Exception("Unknown mode for the adjust_morphogens() method")
 
 
+def morton_order(locations, width):
+    """ Returns the indices that sort the cells along a Morton
+        (Z-order) space-filling curve, such that cells near each
+        other in space are mostly near each other in the order.
+    """
+    # generalize the cell locations to points on an integer lattice with the given spacing, 21 bits for each axis
+    points = np.floor_divide(locations, width).astype(np.int64)
+    points = np.clip(points, 0, 2 ** 21 - 1).astype(np.uint64)
+
+    # interleave the bits of the three axes to get the position of each cell along the curve
+    codes = np.zeros(len(locations), dtype=np.uint64)
+    for axis in range(3):
+        # spread the 21 bits of the axis such that there are two empty bits between each bit
+        x = points[:, axis]
+        x = (x | (x << np.uint64(32))) & np.uint64(0x1f00000000ffff)
+        x = (x | (x << np.uint64(16))) & np.uint64(0x1f0000ff0000ff)
+        x = (x | (x << np.uint64(8))) & np.uint64(0x100f00f00f00f00f)
+        x = (x | (x << np.uint64(4))) & np.uint64(0x10c30c30c30c30c3)
+        x = (x | (x << np.uint64(2))) & np.uint64(0x1249249249249249)
+
+        # offset the bits by the axis and add them to the codes
+        codes |= x << np.uint64(axis)
+
+    # sort with a stable method such that cells at the same point keep their current order
+    return np.argsort(codes, kind="stable")
+
+
 def info(simulation):
     """ Records the beginning of the step in real time and
         prints the current step/number of cells.
@@ -849,7 +2395,7 @@ def random_vector(simulation):
         at the origin.
     """
     # random angle on the cell
-    theta = r.random() * 2 * math.pi
+    theta = simulation.rng.random() * 2 * math.pi
 
     # 2D vector: [x, y, 0]
     if simulation.size[2] == 0:
@@ -857,11 +2403,39 @@ def random_vector(simulation):
 
     # 3D vector: [x, y, z]
     else:
-        phi = r.random() * 2 * math.pi
+        phi = simulation.rng.random() * 2 * math.pi
         radius = math.cos(phi)
         return np.array([radius * math.cos(theta), radius * math.sin(theta), math.sin(phi)])
 
 
+def random_vectors(simulation, number):
+    """ Computes an array of random vectors on the unit sphere
+        centered at the origin, drawing the random angles at once.
+    """
+    # 2D vectors: [x, y, 0]
+    if simulation.size[2] == 0:
+        # random angles on the cells
+        theta = simulation.rng.random(number) * 2 * math.pi
+        return np.stack((np.cos(theta), np.sin(theta), np.zeros(number)), axis=1)
+
+    # 3D vectors: [x, y, z]
+    else:
+        # random angles on the cells
+        angles = simulation.rng.random((number, 2)) * 2 * math.pi
+        theta, phi = angles[:, 0], angles[:, 1]
+        radius = np.cos(phi)
+        return np.stack((radius * np.cos(theta), radius * np.sin(theta), np.sin(phi)), axis=1)
+
+
+def normal_vectors(vectors):
+    """ Returns the array of vectors each normalized, leaving
+        any zero vectors as zero vectors.
+    """
+    # get the magnitude of each vector, using 1 for zero vectors to avoid dividing by 0
+    mags = np.linalg.norm(vectors, axis=1)
+    return vectors / np.where(mags == 0, 1, mags)[:, np.newaxis]
+
+
 def record_time(function):
     """ A decorator used to time individual methods. If a method is called
         more than once, the time will be cumulative for the step.
@@ -1,5 +1,4 @@
 import numpy as np
-import random as r
 import math
 from numba import cuda
 
@@ -11,21 +10,20 @@ def cell_death(simulation):
     """ Marks the cell for removal if it meets
         the criteria for cell death.
     """
-    for index in range(simulation.number_cells):
-        # checks to see if cell is pluripotent
-        if simulation.states[index] == "Pluripotent":
+    # get the number of neighbors for each cell and which cells are pluripotent
+    degrees = simulation.get_derived("degrees")
+    if_pluri = simulation.get_derived("if_pluri")
 
-            # gets the number of neighbors for a cell, increasing the death counter if not enough neighbors
-            if len(simulation.neighbor_graph.neighbors(index)) < simulation.lonely_thresh:
-                simulation.death_counters[index] += 1
+    # get the pluripotent cells without enough neighbors
+    lonely = if_pluri & (degrees < simulation.lonely_thresh)
 
-            # if not, reset the death counter back to zero
-            else:
-                simulation.death_counters[index] = 0
+    # increase the death counter of these cells and reset the death counter of the other pluripotent cells to zero
+    simulation.death_counters[lonely] += 1
+    simulation.death_counters[if_pluri & ~lonely] = 0
 
-            # add cell to removal array if it meets the parameters
-            if simulation.death_counters[index] >= simulation.death_thresh:
-                simulation.cells_to_remove = np.append(simulation.cells_to_remove, index)
+    # add pluripotent cells to removal array if they meet the parameters
+    dying = if_pluri & (simulation.death_counters >= simulation.death_thresh)
+    simulation.cells_to_remove = np.append(simulation.cells_to_remove, np.flatnonzero(dying))
 
 
 @backend.record_time
@@ -33,25 +31,21 @@ def cell_diff_surround(simulation):
     """ Simulates differentiated cells inducing the
         differentiation of a pluripotent cell.
     """
+    # get which cells are pluripotent, which are NANOG high, and the number of differentiated neighbors of each cell
+    if_pluri = simulation.get_derived("if_pluri")
+    if_nanog = simulation.get_derived("if_nanog")
+    diff_neighbors = simulation.get_derived("diff_neighbors")
+
     for index in range(simulation.number_cells):
         # checks to see if cell is pluripotent and GATA6 low/medium
-        if simulation.states[index] == "Pluripotent" and simulation.GATA6[index] < simulation.NANOG[index]:
-
-            # get the list of neighbors for the cell
-            neighbors = simulation.neighbor_graph.neighbors(index)
+        if if_pluri[index] and if_nanog[index]:
+            # if the number of differentiated neighbors meets the threshold, set the cell as gata6 high and nanog low
+            if diff_neighbors[index] >= 6:
+                simulation.GATA6[index] = simulation.field - 1
+                simulation.NANOG[index] = 0
 
-            # loop over neighbors, counting the ones that are differentiated
-            diff_neighbors = 0
-            for neighbor_index in neighbors:
-                # checks to see if current neighbor is differentiated and if so add to the counter
-                if simulation.states[neighbor_index] == "Differentiated":
-                    diff_neighbors += 1
-
-                # if the number of differentiated meets the threshold, set the cell as gata6 high and nanog low
-                if diff_neighbors >= 6:
-                    simulation.GATA6[index] = simulation.field - 1
-                    simulation.NANOG[index] = 0
-                    break
+    # the GATA6 and NANOG values may have changed
+    simulation.clear_derived()
 
 
 @backend.record_time
@@ -59,24 +53,22 @@ def cell_division(simulation):
     """ Increases the cell division counter and if the
         cell meets criteria mark it for division.
     """
-    for index in range(simulation.number_cells):
-        # stochastically increase the division counter by either 0 or 1
-        simulation.div_counters[index] += r.randint(0, 1)
+    # get the number of neighbors for each cell and which cells are pluripotent
+    degrees = simulation.get_derived("degrees")
+    if_pluri = simulation.get_derived("if_pluri")
 
-        # pluripotent cell
-        if simulation.states[index] == "Pluripotent":
-            # check the division counter against the threshold, add to array if dividing
-            if simulation.div_counters[index] >= simulation.pluri_div_thresh:
-                simulation.cells_to_divide = np.append(simulation.cells_to_divide, index)
+    # stochastically increase the division counters by either 0 or 1
+    simulation.div_counters += simulation.rng.integers(0, 2, simulation.number_cells)
 
-        # differentiated cell
-        else:
-            # check the division counter against the threshold, add to array if dividing
-            if simulation.div_counters[index] >= simulation.diff_div_thresh:
+    # check the division counters of the pluripotent cells against the threshold
+    pluri_dividing = if_pluri & (simulation.div_counters >= simulation.pluri_div_thresh)
 
-                # check for contact inhibition since differentiated
-                if len(simulation.neighbor_graph.neighbors(index)) < 6:
-                    simulation.cells_to_divide = np.append(simulation.cells_to_divide, index)
+    # check the division counters of the differentiated cells against the threshold and for contact inhibition
+    diff_dividing = ~if_pluri & (simulation.div_counters >= simulation.diff_div_thresh) & (degrees < 6)
+
+    # add the dividing cells to the array
+    dividing = np.flatnonzero(pluri_dividing | diff_dividing)
+    simulation.cells_to_divide = np.append(simulation.cells_to_divide, dividing)
 
 
 @backend.record_time
@@ -84,19 +76,93 @@ def cell_growth(simulation):
     """ Simulates the growth of a cell currently linear,
         radius-based growth.
     """
-    for index in range(simulation.number_cells):
-        # increase the cell radius based on the state and whether or not it has reached the max size
-        if simulation.radii[index] < simulation.max_radius:
-            # pluripotent growth
-            if simulation.states[index] == "Pluripotent":
-                radius = simulation.pluri_growth * simulation.div_counters[index] + simulation.min_radius
+    # get which cells are pluripotent
+    if_pluri = simulation.get_derived("if_pluri")
 
-            # differentiated growth
-            else:
-                radius = simulation.diff_growth * simulation.div_counters[index] + simulation.min_radius
+    # calculate the radius of each cell from its division counter based on the state
+    pluri_radii = simulation.pluri_growth * simulation.div_counters + simulation.min_radius
+    diff_radii = simulation.diff_growth * simulation.div_counters + simulation.min_radius
+    radii = np.where(if_pluri, pluri_radii, diff_radii)
 
-            # update the radius for the index
-            simulation.radii[index] = radius
+    # increase the cell radius if it hasn't reached the max size
+    growing = simulation.radii < simulation.max_radius
+    simulation.radii[growing] = radii[growing]
+
+
+@backend.record_time
+def cell_rules(simulation):
+    """ Runs the per-cell rules registered in run.py in a single
+        compiled pass over all cells and adds the cells marked to
+        divide or be removed to the queues.
+    """
+    # call the rules for each cell, see CellRules in backend.py
+    dividing, dying = simulation.rules.run(simulation)
+
+    # add the cells marked by the rules to the arrays
+    simulation.cells_to_remove = np.append(simulation.cells_to_remove, np.flatnonzero(dying))
+    simulation.cells_to_divide = np.append(simulation.cells_to_divide, np.flatnonzero(dividing))
+
+    # the rules may have changed the cell arrays
+    simulation.clear_derived()
+
+
+def death_rule(index, cells, params):
+    """ A rule for cell_rules() that marks the cell for
+        removal if it meets the criteria for cell death.
+    """
+    if cells.if_pluri[index]:
+        # increase the death counter if the cell doesn't have enough neighbors, otherwise reset it to zero
+        if cells.degrees[index] < params.lonely_thresh:
+            cells.death_counters[index] += 1
+        else:
+            cells.death_counters[index] = 0
+
+        # mark the cell for removal if it meets the threshold
+        if cells.death_counters[index] >= params.death_thresh:
+            cells.remove[index] = True
+
+
+def diff_surround_rule(index, cells, params):
+    """ A rule for cell_rules() that simulates differentiated
+        cells inducing the differentiation of a pluripotent cell.
+    """
+    # checks to see if cell is pluripotent and GATA6 low/medium
+    if cells.if_pluri[index] and cells.if_nanog[index]:
+        # if the number of differentiated neighbors meets the threshold, set the cell as gata6 high and nanog low
+        if cells.diff_neighbors[index] >= 6:
+            cells.GATA6[index] = params.field - 1
+            cells.NANOG[index] = 0
+
+
+def division_rule(index, cells, params):
+    """ A rule for cell_rules() that increases the cell division
+        counter and if the cell meets criteria marks it for division.
+    """
+    # stochastically increase the division counter by either 0 or 1
+    if backend.cell_random(params.key, index, 0) < 0.5:
+        cells.div_counters[index] += 1
+
+    # check the division counter of a pluripotent cell against the threshold
+    if cells.if_pluri[index]:
+        if cells.div_counters[index] >= params.pluri_div_thresh:
+            cells.divide[index] = True
+
+    # check the division counter of a differentiated cell against the threshold and for contact inhibition
+    else:
+        if cells.div_counters[index] >= params.diff_div_thresh and cells.degrees[index] < 6:
+            cells.divide[index] = True
+
+
+def growth_rule(index, cells, params):
+    """ A rule for cell_rules() that simulates the growth of a
+        cell currently linear, radius-based growth.
+    """
+    # increase the cell radius based on the state if it hasn't reached the max size
+    if cells.radii[index] < params.max_radius:
+        if cells.if_pluri[index]:
+            cells.radii[index] = params.pluri_growth * cells.div_counters[index] + params.min_radius
+        else:
+            cells.radii[index] = params.diff_growth * cells.div_counters[index] + params.min_radius
 
 
 @backend.record_time
@@ -104,98 +170,50 @@ def cell_pathway(simulation):
     """ Updates finite dynamical system variables and
         extracellular conditions.
     """
-    for index in range(simulation.number_cells):
-        # add FGF4 to the gradient based on the cell's value of NANOG
-        if simulation.NANOG[index] > 0:
-            # get the amount
-            amount = simulation.NANOG[index]
-
-            # add it to the normal FGF4 gradient and the alternative FGF4 gradient
-            backend.adjust_morphogens(simulation, "fgf4_values", index, amount, "nearest")
-            # backend.adjust_morphogens(simulation, "fgf4_alt", index, amount, "distance")
-
-        # activate the following pathway based on if doxycycline  has been induced yet (after 24 hours/48 steps)
-        if simulation.current_step >= simulation.dox_step:
-            # get an FGF4 value for the FDS based on the concentration of FGF4
-            fgf4_value = backend.get_concentration(simulation, "fgf4_values", index)
-
-            # if FDS is boolean
-            if simulation.field == 2:
-                # base thresholds on the maximum concentrations
-                if fgf4_value < 0.5 * simulation.max_concentration:
-                    fgf4_fds = 0   # FGF4 low
-                else:
-                    fgf4_fds = 1    # FGF4 high
-
-            # otherwise assume ternary for now
-            else:
-                # base thresholds on the maximum concentrations
-                if fgf4_value < 1/3 * simulation.max_concentration:
-                    fgf4_fds = 0    # FGF4 low
-                elif fgf4_value < 2/3 * simulation.max_concentration:
-                    fgf4_fds = 1    # FGF4 medium
-                else:
-                    fgf4_fds = 2    # FGF4 high
-
-            # temporarily hold the FGFR value
-            temp_fgfr = simulation.FGFR[index]
-
-            # if updating the FDS values this step
-            if simulation.fds_counters[index] % simulation.fds_thresh == 0:
-                # get the current FDS values of the cell
-                x1 = fgf4_fds
-                x2 = simulation.FGFR[index]
-                x3 = simulation.ERK[index]
-                x4 = simulation.GATA6[index]
-                x5 = simulation.NANOG[index]
-
-                # if the FDS is boolean
-                if simulation.field == 2:
-                    # update boolean values based on FDS functions
-                    new_fgfr = (x1 * x4) % 2
-                    new_erk = x2 % 2
-                    new_gata6 = (1 + x5 + x5 * x4) % 2
-                    new_nanog = ((x3 + 1) * (x4 + 1)) % 2
-
-                # otherwise assume ternary
-                else:
-                    # update ternary values based on FDS functions
-                    new_fgfr = (x1 * x4 * ((2*x1 + 1) * (2*x4 + 1) + x1 * x4)) % 3
-                    new_erk = x2 % 3
-                    new_gata6 = ((x4**2) * (x5 + 1) + (x5**2) * (x4 + 1) + 2*x5 + 1) % 3
-                    new_nanog = (x5**2 + x5 * (x5 + 1) * (x3 * (2*x4**2 + 2*x3 + 1) + x4*(2*x3**2 + 2*x4 + 1)) +
-                                 (2*x3**2 + 1) * (2*x4**2 + 1)) % 3
-
-                # if the amount of FGFR has increased, subtract that much FGF4 from the gradient
-                fgfr_change = new_fgfr - temp_fgfr
-                if fgfr_change > 0:
-                    backend.adjust_morphogens(simulation, "fgf4_values", index, -1 * fgfr_change, "nearest")
-
-                # update the FDS values of the cell
-                simulation.FGFR[index] = new_fgfr
-                simulation.ERK[index] = new_erk
-                simulation.GATA6[index] = new_gata6
-                simulation.NANOG[index] = new_nanog
-
-            # increase the finite dynamical system counter
-            simulation.fds_counters[index] += 1
-
-            # if the cell is GATA6 high and pluripotent
-            if simulation.GATA6[index] > simulation.NANOG[index] and simulation.states[index] == "Pluripotent":
-
-                # increase the differentiation counter by 0 or 1
-                simulation.diff_counters[index] += r.randint(0, 1)
-
-                # if the differentiation counter is greater than or equal to the threshold, differentiate
-                if simulation.diff_counters[index] >= simulation.pluri_to_diff:
-                    # change the state to differentiated
-                    simulation.states[index] = "Differentiated"
-
-                    # make sure NANOG is low
-                    simulation.NANOG[index] = 0
-
-                    # allow the cell to actively move again
-                    simulation.motion[index] = True
+    # find the nearest diffusion point of each cell
+    half_indices = np.floor(2 * simulation.locations / simulation.spat_res)
+    indices = np.ceil(half_indices / 2).astype(int)
+
+    # activate the following pathway based on if doxycycline  has been induced yet (after 24 hours/48 steps)
+    if simulation.current_step >= simulation.dox_step:
+        # make the lookup table of the FDS update functions if it hasn't been made for this field and these functions
+        fds_table_key = (simulation.field, simulation.fds_functions)
+        if simulation.fds_table is None or simulation.fds_table_key != fds_table_key:
+            simulation.fds_table = backend.make_fds_table(simulation.field, simulation.fds_functions)
+            simulation.fds_table_key = fds_table_key
+
+        # the FGF4 concentrations that divide the concentrations into as many FGF4 values as the field, such as
+        # 1/3 and 2/3 of the maximum concentration for the ternary FDS
+        thresholds = np.arange(1, simulation.field) / simulation.field * simulation.max_concentration
+
+        # add and take up FGF4 while updating the FDS values of each cell, see update_pathway_jit()
+        simulation.fgf4_values, simulation.FGFR, simulation.ERK, simulation.GATA6, simulation.NANOG, \
+            simulation.fds_counters = backend.update_pathway_jit(simulation.number_cells, indices,
+                                                                 simulation.fgf4_values, simulation.FGFR,
+                                                                 simulation.ERK, simulation.GATA6, simulation.NANOG,
+                                                                 simulation.fds_counters, simulation.fds_thresh,
+                                                                 simulation.fds_table, thresholds)
+
+        # get the cells that are GATA6 high and pluripotent, the states haven't changed since the cache was cleared
+        gata6_pluri = np.flatnonzero((simulation.GATA6 > simulation.NANOG) & simulation.get_derived("if_pluri"))
+
+        # increase the differentiation counter by 0 or 1
+        simulation.diff_counters[gata6_pluri] += simulation.rng.integers(0, 2, len(gata6_pluri))
+
+        # if the differentiation counter is greater than or equal to the threshold, differentiate
+        differentiate = gata6_pluri[simulation.diff_counters[gata6_pluri] >= simulation.pluri_to_diff]
+
+        # change the state to differentiated, make sure NANOG is low, and allow the cell to actively move again
+        simulation.states[differentiate] = simulation.get_code("states", "Differentiated")
+        simulation.NANOG[differentiate] = 0
+        simulation.motion[differentiate] = True
+
+    # otherwise only add FGF4 to the gradient based on the cell's value of NANOG
+    else:
+        np.add.at(simulation.fgf4_values, (indices[:, 0], indices[:, 1], indices[:, 2]), simulation.NANOG)
+
+    # the FDS values and states may have changed
+    simulation.clear_derived()
 
 
 @backend.record_time
@@ -209,68 +227,46 @@ def cell_motility(simulation):
     # reset motility forces to zero vector
     simulation.motility_forces[:, :] = 0
 
-    # loop over all of the cells
-    for index in range(simulation.number_cells):
-        # get the neighbors of the cell
-        neighbors = simulation.neighbor_graph.neighbors(index)
-
-        # if not surrounded 6 or more cells, calculate motility forces
-        if len(neighbors) < 6:
-            # if the cell state is differentiated
-            if simulation.states[index] == "Differentiated":
-                # create a vector to hold the sum of normal vectors between a cell and its neighbors
-                vector_holder = np.array([0.0, 0.0, 0.0])
-
-                # loop over the neighbors
-                count = 0
-                for i in range(len(neighbors)):
-                    # if neighbor is nanog high, add vector to the cell to the holder
-                    if simulation.NANOG[neighbors[i]] > simulation.GATA6[neighbors[i]]:
-                        count += 1
-                        vector = simulation.locations[neighbors[i]] - simulation.locations[index]
-                        vector_holder += vector
-
-                # if there is at least one nanog high cell move away from it
-                if count > 0:
-                    # get the normalized vector
-                    normal = backend.normal_vector(vector_holder)
-
-                    # move in direction opposite to nanog high cells
-                    random = backend.random_vector(simulation)
-                    simulation.motility_forces[index] += (normal * -0.8 + random * 0.2) * motility_force
-
-                # if no nanog high cells around, move randomly
-                else:
-                    simulation.motility_forces[index] += backend.random_vector(simulation) * motility_force
-
-            # if the cell is gata6 high and nanog low
-            elif simulation.GATA6[index] > simulation.NANOG[index]:
-                # continue if using Guye et al. movement and if there exists differentiated cells
-                if simulation.guye_move and simulation.nearest_diff[index] != -1:
-                    # get the differentiated neighbor
-                    guye_neighbor = simulation.nearest_diff[index]
-
-                    # get the normal vector
-                    vector = simulation.locations[guye_neighbor] - simulation.locations[index]
-                    normal = backend.normal_vector(vector)
-
-                    # calculate the motility force
-                    random = backend.random_vector(simulation)
-                    simulation.motility_forces[index] += (normal * 0.8 + random * 0.2) * motility_force
-
-                # if no Guye movement or no differentiated cells nearby, move randomly
-                else:
-                    simulation.motility_forces[index] += backend.random_vector(simulation) * motility_force
-
-            # if the cell is nanog high and gata6 low
-            elif simulation.NANOG[index] > simulation.GATA6[index]:
-                # move randomly
-                simulation.motility_forces[index] += backend.random_vector(simulation) * motility_force
-
-            # if both gata6/nanog high or both low
-            else:
-                # move randomly
-                simulation.motility_forces[index] += backend.random_vector(simulation) * motility_force
+    # get the number of neighbors for each cell and the type of each cell
+    degrees = simulation.get_derived("degrees")
+    if_diff = simulation.get_derived("if_diff")
+    if_gata6 = simulation.get_derived("if_gata6")
+    if_nanog = simulation.get_derived("if_nanog")
+
+    # only cells not surrounded by 6 or more cells have motility forces
+    moving = degrees < 6
+    number_moving = np.sum(moving)
+
+    # each moving cell has a random component to its movement
+    random = np.zeros((simulation.number_cells, 3))
+    random[moving] = backend.random_vectors(simulation, number_moving)
+
+    # by default, move randomly
+    forces = random * motility_force
+
+    # sum the vectors from each cell to its nanog high neighbors, going through the neighbors in the CSR arrays
+    graph = simulation.neighbor_graph
+    rows = np.repeat(np.arange(simulation.number_cells), degrees)
+    nanog_edges = if_nanog[graph.indices]
+    cells, neighbors = rows[nanog_edges], graph.indices[nanog_edges]
+    vector_holder = np.zeros((simulation.number_cells, 3))
+    np.add.at(vector_holder, cells, simulation.locations[neighbors] - simulation.locations[cells])
+    count = np.bincount(cells, minlength=simulation.number_cells)
+
+    # if a differentiated cell has at least one nanog high neighbor, move in direction opposite to those cells
+    away = moving & if_diff & (count > 0)
+    normal = backend.normal_vectors(vector_holder[away])
+    forces[away] = (normal * -0.8 + random[away] * 0.2) * motility_force
+
+    # if using Guye et al. movement, a gata6 high cell with a nearby differentiated cell moves toward it
+    if simulation.guye_move:
+        toward = moving & ~if_diff & if_gata6 & (simulation.nearest_diff != -1)
+        vector = simulation.locations[simulation.nearest_diff[toward]] - simulation.locations[toward]
+        normal = backend.normal_vectors(vector)
+        forces[toward] = (normal * 0.8 + random[toward] * 0.2) * motility_force
+
+    # update the motility forces of the moving cells
+    simulation.motility_forces[moving] += forces[moving]
 
 
 @backend.record_time
@@ -285,67 +281,22 @@ def eunbi_motility(simulation):
     # reset motility forces to zero vector
     simulation.motility_forces[:, :] = 0
 
-    # loop over all of the cells
-    for index in range(simulation.number_cells):
-        # see if the cell is moving or not
-        if simulation.motion[index]:
-            # get the neighbors of the cell if the cell is actively moving
-            neighbors = simulation.neighbor_graph.neighbors(index)
-
-            # if cell is not surrounded by 6 or more other cells, calculate motility forces
-            if len(neighbors) < 6:
-                # if differentiated
-                if simulation.states[index] == "Differentiated":
-                    # if there is a nanog high cell nearby, move away from it
-                    if simulation.nearest_nanog[index] != -1:
-                        nearest_index = simulation.nearest_nanog[index]
-                        vector = simulation.locations[nearest_index] - simulation.cell_locations[index]
-                        normal = backend.normal_vector(vector)
-                        random = backend.random_vector(simulation)
-                        simulation.motility_forces[index] += (normal * -0.8 + random * 0.2) * motility_force
-
-                    # if no nearby nanog high cells, move randomly
-                    else:
-                        simulation.motility_forces[index] += backend.random_vector(simulation) * motility_force
-
-                # if the cell is gata6 high and nanog low
-                elif simulation.GATA6[index] > simulation.NANOG[index]:
-                    # if there is a differentiated cell nearby, move toward it
-                    if simulation.nearest_diff[index] != -1:
-                        nearest_index = simulation.nearest_diff[index]
-                        vector = simulation.locations[nearest_index] - simulation.locations[index]
-                        normal = backend.normal_vector(vector)
-                        random = backend.random_vector(simulation)
-                        simulation.motility_forces[index] += (normal * 0.8 + random * 0.2) * motility_force
-
-                    # if no nearby differentiated cells, move randomly
-                    else:
-                        simulation.motility_forces[index] += backend.random_vector(simulation) * motility_force
-
-                # if the cell is nanog high and gata6 low
-                elif simulation.NANOG[index] > simulation.GATA6[index]:
-                    # if there is a nanog high cell nearby, move toward it
-                    if simulation.nearest_nanog[index] != -1:
-                        nearest_index = simulation.nearest_nanog[index]
-                        vector = simulation.locations[nearest_index] - simulation.locations[index]
-                        normal = backend.normal_vector(vector)
-                        random = backend.random_vector(simulation)
-                        simulation.motility_forces[index] += (normal * 0.8 + random * 0.2) * motility_force
-
-                    # if there is a gata6 high cell nearby, move away from it
-                    elif simulation.nearest_gata6[index] != -1:
-                        nearest_index = simulation.nearest_gata6[index]
-                        vector = simulation.locations[nearest_index] - simulation.locations[index]
-                        normal = backend.normal_vector(vector)
-                        random = backend.random_vector(simulation)
-                        simulation.motility_forces[index] += (normal * -0.8 + random * 0.2) * motility_force
-
-                    else:
-                        simulation.motility_forces[index] += backend.random_vector(simulation) * motility_force
-
-                # if both gata6/nanog high or both low, move randomly
-                else:
-                    simulation.motility_forces[index] += backend.random_vector(simulation) * motility_force
+    # get the number of neighbors for each cell and the type of each cell
+    degrees = simulation.get_derived("degrees")
+    if_diff = simulation.get_derived("if_diff")
+    if_gata6 = simulation.get_derived("if_gata6")
+    if_nanog = simulation.get_derived("if_nanog")
+
+    # get a key for the random vectors of the cells, which are drawn from a separate stream for each cell in parallel
+    seed = simulation.rng.stream_key()
+
+    # call the jit cpu version
+    simulation.motility_forces = backend.eunbi_motility_cpu(simulation.number_cells, simulation.locations,
+                                                            simulation.motion, degrees, if_diff, if_gata6,
+                                                            if_nanog, simulation.nearest_gata6,
+                                                            simulation.nearest_nanog, simulation.nearest_diff,
+                                                            simulation.motility_forces, motility_force, seed,
+                                                            simulation.size[2] == 0)
 
 
 @backend.record_time
@@ -354,113 +305,131 @@ def get_neighbors(simulation, distance=0.00002):
         radius to denote a neighbor then stores this information
         in a graph (uses a bin/bucket sorting method).
     """
-    # if a static variable has not been created to hold the maximum number of neighbors for a cell, create one
-    if not hasattr(get_neighbors, "max_neighbors"):
-        # begin with a low number of neighbors that can be revalued if the max number of neighbors exceeds this value
-        get_neighbors.max_neighbors = 5
-
-    # if a static variable has not been created to hold the maximum number of cells in a bin, create one
-    if not hasattr(get_neighbors, "max_cells"):
-        # begin with a low number of cells that can be revalued if the max number of cells exceeds this value
-        get_neighbors.max_cells = 5
-
-    # clear all of the edges in the neighbor graph
-    simulation.neighbor_graph.delete_edges(None)
-
-    # calls the function that generates an array of bins that generalize the cell locations in addition to a
-    # creating a helper array that assists the search method in counting cells for a particular bin
-    bins, bins_help, bin_locations, max_cells = backend.assign_bins(simulation, distance, get_neighbors.max_cells)
-
-    # update the value of the max number of cells in a bin
-    get_neighbors.max_cells = max_cells
-
-    # this will run once if all edges are included in edge_holder, breaking the loop. if not, this will
-    # run a second time with an updated value for the number of predicted neighbors such that all edges are included
-    while True:
-        # create an array used to hold edges, an array to say if edge exists, and an array to count the edges per cell
-        length = simulation.number_cells * get_neighbors.max_neighbors
-        edge_holder = np.zeros((length, 2), dtype=int)
-        if_edge = np.zeros(length, dtype=bool)
-        edge_count = np.zeros(simulation.number_cells, dtype=int)
-
-        # call the nvidia gpu version
-        if simulation.parallel:
-            # send the following as arrays to the gpu
-            bin_locations_cuda = cuda.to_device(bin_locations)
-            locations_cuda = cuda.to_device(simulation.locations)
-            bins_cuda = cuda.to_device(bins)
-            bins_help_cuda = cuda.to_device(bins_help)
-            distance_cuda = cuda.to_device(distance)
-            edge_holder_cuda = cuda.to_device(edge_holder)
-            if_edge_cuda = cuda.to_device(if_edge)
-            edge_count_cuda = cuda.to_device(edge_count)
-            max_neighbors_cuda = cuda.to_device(get_neighbors.max_neighbors)
+    # replace the edges of the neighbor graph, building its CSR arrays directly from the edges
+    simulation.neighbor_graph.set_edges(neighbor_edges(simulation, distance))
 
-            # allocate threads and blocks for gpu memory "threads per block" and "blocks per grid"
-            tpb = 72
-            bpg = math.ceil(simulation.number_cells / tpb)
+    # the number of neighbors of each cell has changed
+    simulation.clear_derived()
 
-            # call the cuda kernel with new gpu arrays
-            backend.get_neighbors_gpu[bpg, tpb](bin_locations_cuda, locations_cuda, bins_cuda, bins_help_cuda,
-                                                distance_cuda, edge_holder_cuda, if_edge_cuda, edge_count_cuda,
-                                                max_neighbors_cuda)
 
-            # return the only the following array(s) back from the gpu
-            edge_holder = edge_holder_cuda.copy_to_host()
-            if_edge = if_edge_cuda.copy_to_host()
-            edge_count = edge_count_cuda.copy_to_host()
+def neighbor_edges(simulation, distance):
+    """ Returns an array of edges between all cells that fall
+        within a fixed radius of each other. Used by get_neighbors()
+        and for the candidate pairs of jkr_neighbors().
+    """
+    # if using a k-d tree instead of bins, get the pairs from the tree
+    if simulation.search_method == "kdtree":
+        tree = simulation.spatial_index.get_tree(simulation)
+        return tree.query_pairs(distance, output_type="ndarray")
 
-        # call the jit cpu version
-        else:
-            edge_holder, if_edge, edge_count = backend.get_neighbors_cpu(simulation.number_cells, bin_locations,
-                                                                         simulation.locations, bins, bins_help,
-                                                                         distance, edge_holder, if_edge, edge_count,
-                                                                         get_neighbors.max_neighbors)
-
-        # either break the loop if all neighbors were accounted for or revalue the maximum number of neighbors
-        # based on the output of the function call and double it for future calls
-        max_neighbors = np.amax(edge_count)
-        if get_neighbors.max_neighbors >= max_neighbors:
-            break
-        else:
-            get_neighbors.max_neighbors = max_neighbors * 2
+    # get the array of cells sorted by bin that generalizes the cell locations in addition to helper arrays that
+    # assist the search method in finding the cells of a particular bin, these are shared by searches with the same
+    # bin width
+    bins, bins_help, bins_start, bins_table, bin_locations = simulation.spatial_index.get_bins(simulation, distance)
+
+    # create an array to count the edges per cell, the edge holder is empty for the first call which only counts edges
+    edge_holder = np.zeros((0, 2), dtype=int)
+    edge_start = np.zeros(simulation.number_cells, dtype=int)
+    edge_count = np.zeros(simulation.number_cells, dtype=int)
+
+    # call the nvidia gpu version
+    if simulation.parallel:
+        # send the following as arrays to the gpu
+        bin_locations_cuda = cuda.to_device(bin_locations)
+        locations_cuda = cuda.to_device(simulation.locations)
+        bins_cuda = cuda.to_device(bins)
+        bins_help_cuda = cuda.to_device(bins_help)
+        bins_start_cuda = cuda.to_device(bins_start)
+        bins_table_cuda = cuda.to_device(bins_table)
+        distance_cuda = cuda.to_device(distance)
+        edge_count_cuda = cuda.to_device(edge_count)
+
+        # allocate threads and blocks for gpu memory "threads per block" and "blocks per grid"
+        tpb = 72
+        bpg = math.ceil(simulation.number_cells / tpb)
 
-    # reduce the edges to only edges that actually exist
-    edge_holder = edge_holder[if_edge]
+        # call the cuda kernel once to count the edges of each cell
+        backend.get_neighbors_gpu[bpg, tpb](bin_locations_cuda, locations_cuda, bins_cuda, bins_help_cuda,
+                                            bins_start_cuda, bins_table_cuda, distance_cuda,
+                                            cuda.to_device(edge_holder), cuda.to_device(edge_start), edge_count_cuda,
+                                            cuda.to_device(False))
+        edge_count = edge_count_cuda.copy_to_host()
 
-    # add the edges to the neighbor graph
-    simulation.neighbor_graph.add_edges(edge_holder)
+        # get where the edges of each cell begin and make an edge holder that fits all of the edges
+        edge_start = np.cumsum(edge_count) - edge_count
+        edge_holder_cuda = cuda.to_device(np.empty((np.sum(edge_count), 2), dtype=int))
+
+        # call the cuda kernel again to fill the edge holder
+        backend.get_neighbors_gpu[bpg, tpb](bin_locations_cuda, locations_cuda, bins_cuda, bins_help_cuda,
+                                            bins_start_cuda, bins_table_cuda, distance_cuda, edge_holder_cuda,
+                                            cuda.to_device(edge_start), edge_count_cuda, cuda.to_device(True))
+
+        # return the only the following array(s) back from the gpu
+        edge_holder = edge_holder_cuda.copy_to_host()
+
+    # call the jit cpu version
+    else:
+        # use the version of the function specialized for a 2D space if the space has no depth
+        get_neighbors_cpu = backend.get_neighbors_cpu_2d if simulation.size[2] == 0 else backend.get_neighbors_cpu
+
+        # call the function once to count the edges of each cell
+        edge_holder, edge_count = get_neighbors_cpu(simulation.number_cells, bin_locations,
+                                                    simulation.locations, bins, bins_help, bins_start, bins_table,
+                                                    distance, edge_holder, edge_start, edge_count, False)
+
+        # get where the edges of each cell begin and make an edge holder that fits all of the edges
+        edge_start = np.cumsum(edge_count) - edge_count
+        edge_holder = np.empty((np.sum(edge_count), 2), dtype=int)
+
+        # call the function again to fill the edge holder
+        edge_holder, edge_count = get_neighbors_cpu(simulation.number_cells, bin_locations,
+                                                    simulation.locations, bins, bins_help, bins_start, bins_table,
+                                                    distance, edge_holder, edge_start, edge_count, True)
+
+    return edge_holder
 
 
 @backend.record_time
-def nearest(simulation, distance=0.00002):
+def nearest(simulation, distance=0.00002, max_distance=None):
     """ Determines the nearest GATA6 high, NANOG high, and
         differentiated cell within a fixed radius for each
-        cell.
+        cell. The CPU version bins each type of cell separately,
+        where the bins are "distance" wide and the search may
+        extend in rings of bins out to "max_distance".
     """
-    # if a static variable has not been created to hold the maximum number of cells in a bin, create one
-    if not hasattr(nearest, "max_cells"):
-        # begin with a low number of cells that can be revalued if the max number of cells exceeds this value
-        nearest.max_cells = 5
-
-    # calls the function that generates an array of bins that generalize the cell locations in addition to a
-    # creating a helper array that assists the search method in counting cells for a particular bin
-    bins, bins_help, bin_locations, max_cells = backend.assign_bins(simulation, distance, nearest.max_cells)
-
-    # update the value of the max number of cells in a bin
-    nearest.max_cells = max_cells
-
-    # turn the following array into True/False instead of strings
-    if_diff = simulation.states == "Differentiated"
+    # if no maximum distance is specified, only search within the width of a bin
+    if max_distance is None:
+        max_distance = distance
+
+    # get the cells of each type, a differentiated cell is not counted as GATA6 or NANOG high
+    if_diff = simulation.get_derived("if_diff")
+    if_gata6 = np.logical_and(~if_diff, simulation.get_derived("if_gata6"))
+    if_nanog = np.logical_and(~if_diff, simulation.get_derived("if_nanog"))
+
+    # if using a k-d tree instead of bins, search a separate tree for each type of cell
+    if simulation.search_method == "kdtree":
+        # revalue the array holding the indices of nearest cells of given type
+        simulation.nearest_gata6 = backend.nearest_tree(simulation.locations, if_gata6, max_distance)
+        simulation.nearest_nanog = backend.nearest_tree(simulation.locations, if_nanog, max_distance)
+        simulation.nearest_diff = backend.nearest_tree(simulation.locations, if_diff, max_distance)
+        return
 
     # call the nvidia gpu version
     if simulation.parallel:
+        # get the array of cells sorted by bin that generalizes the cell locations in addition to helper arrays that
+        # assist the search method in finding the cells of a particular bin, the gpu version only searches the
+        # surrounding bins so these are as wide as the search radius
+        grid = simulation.spatial_index.get_bins(simulation, max_distance)
+        bins, bins_help, bins_start, bins_table, bin_locations = grid
+
         # send the following as arrays to the gpu
         bin_locations_cuda = cuda.to_device(bin_locations)
         locations_cuda = cuda.to_device(simulation.locations)
         bins_cuda = cuda.to_device(bins)
         bins_help_cuda = cuda.to_device(bins_help)
-        distance_cuda = cuda.to_device(distance)
+        bins_start_cuda = cuda.to_device(bins_start)
+        bins_table_cuda = cuda.to_device(bins_table)
+        distance_cuda = cuda.to_device(max_distance)
         if_diff_cuda = cuda.to_device(if_diff)
         gata6_cuda = cuda.to_device(simulation.GATA6)
         nanog_cuda = cuda.to_device(simulation.NANOG)
@@ -473,26 +442,40 @@ def nearest(simulation, distance=0.00002):
         bpg = math.ceil(simulation.number_cells / tpb)
 
         # call the cuda kernel with new gpu arrays
-        backend.nearest_gpu[bpg, tpb](bin_locations_cuda, locations_cuda, bins_cuda, bins_help_cuda, distance_cuda,
-                                      if_diff_cuda, gata6_cuda, nanog_cuda, nearest_gata6_cuda, nearest_nanog_cuda,
-                                      nearest_diff_cuda)
+        backend.nearest_gpu[bpg, tpb](bin_locations_cuda, locations_cuda, bins_cuda, bins_help_cuda, bins_start_cuda,
+                                      bins_table_cuda, distance_cuda, if_diff_cuda, gata6_cuda, nanog_cuda,
+                                      nearest_gata6_cuda, nearest_nanog_cuda, nearest_diff_cuda)
 
-        # return the only the following array(s) back from the gpu
-        gata6 = nearest_gata6_cuda.copy_to_host()
-        nanog = nearest_nanog_cuda.copy_to_host()
-        diff = nearest_diff_cuda.copy_to_host()
+        # revalue the array holding the indices of nearest cells of given type
+        simulation.nearest_gata6 = nearest_gata6_cuda.copy_to_host()
+        simulation.nearest_nanog = nearest_nanog_cuda.copy_to_host()
+        simulation.nearest_diff = nearest_diff_cuda.copy_to_host()
 
     # call the cpu version
     else:
-        gata6, nanog, diff = backend.nearest_cpu(simulation.number_cells, bin_locations, simulation.locations,
-                                                 bins, bins_help, distance, if_diff, simulation.GATA6, simulation.NANOG,
-                                                 simulation.nearest_gata6, simulation.nearest_nanog,
-                                                 simulation.nearest_diff)
+        # use the version of the function specialized for a 2D space if the space has no depth
+        nearest_cpu = backend.nearest_type_cpu_2d if simulation.size[2] == 0 else backend.nearest_type_cpu
 
-    # revalue the array holding the indices of nearest cells of given type
-    simulation.nearest_gata6 = gata6
-    simulation.nearest_nanog = nanog
-    simulation.nearest_diff = diff
+        # generalize the cell locations to bin indices, which are shared by the bins for each type of cell, and
+        # offset by 1 to prevent missing cells that fall out of the simulation space
+        bin_locations = np.floor_divide(simulation.locations, distance).astype(int)
+        bin_locations += 1
+
+        # search the bins of each type separately, such that a rare type of cell is quickly searched
+        for name, of_type in (("nearest_gata6", if_gata6), ("nearest_nanog", if_nanog), ("nearest_diff", if_diff)):
+            # if there are no cells of this type then no cell has a nearest cell of the type
+            if not np.any(of_type):
+                setattr(simulation, name, -1 * np.ones(simulation.number_cells, dtype=int))
+                continue
+
+            # place only the cells of this type in bins
+            indices, bins, bins_help, bins_start, bins_table = backend.assign_type_bins(bin_locations, of_type)
+
+            # revalue the array holding the indices of nearest cells of given type
+            holder = np.empty(simulation.number_cells, dtype=int)
+            setattr(simulation, name, nearest_cpu(simulation.number_cells, bin_locations, simulation.locations,
+                                                  indices, bins, bins_help, bins_start, bins_table, distance,
+                                                  max_distance, holder))
 
 
 @backend.record_time
@@ -501,84 +484,109 @@ def jkr_neighbors(simulation):
         interactions with other cells and puts this information
         into a graph.
     """
+    # if using a skin, reuse the pairs of cells found with a search radius padded by the skin (a Verlet list) until
+    # a cell has moved more than half of the skin, otherwise search the bins for the interactions
+    if simulation.jkr_skin > 0:
+        # the furthest distance apart (meters) two cells can be while having a physical interaction
+        reach = 2 * max(simulation.max_radius, np.amax(simulation.radii, initial=0))
+
+        # only use the locations of the current cells, as the cell arrays may already hold cells being added
+        locations = simulation.locations[:simulation.number_cells]
+
+        # find new candidate pairs if the held pairs may be missing an interaction
+        if simulation.jkr_list.needs_update(locations, reach, simulation.jkr_skin):
+            pairs = neighbor_edges(simulation, reach + simulation.jkr_skin)
+            simulation.jkr_list.update(pairs, locations, reach)
+
+        # get the candidate pairs that have 0 or more overlap
+        edge_holder = simulation.jkr_list.contacts(locations, simulation.radii)
+
+    else:
+        edge_holder = jkr_edges(simulation)
+
+    # merge the edges with the held edges, keeping each edge once, as this graph is never cleared due to its use for
+    # holding adhesive JKR bonds from step to step
+    simulation.jkr_graph.add_edges(edge_holder)
+
+
+def jkr_edges(simulation):
+    """ Returns an array of edges between all cells that have
+        0 or more overlap, used by jkr_neighbors().
+    """
     # radius of search (meters) in which neighbors will have physical interactions, double the max cell radius
     jkr_distance = 2 * simulation.max_radius
 
-    # if a static variable has not been created to hold the maximum number of neighbors for a cell, create one
-    if not hasattr(jkr_neighbors, "max_neighbors"):
-        # begin with a low number of neighbors that can be revalued if the max number of neighbors exceeds this value
-        jkr_neighbors.max_neighbors = 5
+    # if using a k-d tree instead of bins, get the pairs within the search radius that have 0 or more overlap
+    if simulation.search_method == "kdtree":
+        tree = simulation.spatial_index.get_tree(simulation)
+        pairs = tree.query_pairs(jkr_distance, output_type="ndarray")
+        return backend.get_contacts(pairs, simulation.locations, simulation.radii)
 
-    # if a static variable has not been created to hold the maximum number of cells in a bin, create one
-    if not hasattr(jkr_neighbors, "max_cells"):
-        # begin with a low number of cells that can be revalued if the max number of cells exceeds this value
-        jkr_neighbors.max_cells = 5
+    # get the array of cells sorted by bin that generalizes the cell locations in addition to helper arrays that
+    # assist the search method in finding the cells of a particular bin, these are shared by searches with the same
+    # bin width
+    bins, bins_help, bins_start, bins_table, bin_locations = simulation.spatial_index.get_bins(simulation, jkr_distance)
 
-    # this will run once if all edges are included in edge_holder, breaking the loop. if not, this will
-    # run a second time with an updated value for the number of predicted neighbors such that all edges are included
-    bins, bins_help, bin_locations, max_cells = backend.assign_bins(simulation, jkr_distance, jkr_neighbors.max_cells)
+    # create an array to count the edges per cell, the edge holder is empty for the first call which only counts edges
+    edge_holder = np.zeros((0, 2), dtype=int)
+    edge_start = np.zeros(simulation.number_cells, dtype=int)
+    edge_count = np.zeros(simulation.number_cells, dtype=int)
 
-    # update the value of the max number of cells in a bin
-    jkr_neighbors.max_cells = max_cells
+    # send the following as arrays to the gpu
+    if simulation.parallel:
+        # turn the following into arrays that can be interpreted by the gpu
+        bin_locations_cuda = cuda.to_device(bin_locations)
+        locations_cuda = cuda.to_device(simulation.locations)
+        radii_cuda = cuda.to_device(simulation.radii)
+        bins_cuda = cuda.to_device(bins)
+        bins_help_cuda = cuda.to_device(bins_help)
+        bins_start_cuda = cuda.to_device(bins_start)
+        bins_table_cuda = cuda.to_device(bins_table)
+        edge_count_cuda = cuda.to_device(edge_count)
 
-    # this will run once and if all edges are included in edge_holder, the loop will break. if not this will
-    # run a second time with an updated value for number of predicted neighbors such that all edges are included
-    while True:
-        # create an array used to hold edges, an array to say where edges are, and an array to count the edges per cell
-        length = simulation.number_cells * jkr_neighbors.max_neighbors
-        edge_holder = np.zeros((length, 2), dtype=int)
-        if_edge = np.zeros(length, dtype=bool)
-        edge_count = np.zeros(simulation.number_cells, dtype=int)
+        # allocate threads and blocks for gpu memory "threads per block" and "blocks per grid"
+        tpb = 72
+        bpg = math.ceil(simulation.number_cells / tpb)
 
-        # send the following as arrays to the gpu
-        if simulation.parallel:
-            # turn the following into arrays that can be interpreted by the gpu
-            bin_locations_cuda = cuda.to_device(bin_locations)
-            locations_cuda = cuda.to_device(simulation.locations)
-            radii_cuda = cuda.to_device(simulation.radii)
-            bins_cuda = cuda.to_device(bins)
-            bins_help_cuda = cuda.to_device(bins_help)
-            edge_holder_cuda = cuda.to_device(edge_holder)
-            if_edge_cuda = cuda.to_device(if_edge)
-            edge_count_cuda = cuda.to_device(edge_count)
-            max_neighbors_cuda = cuda.to_device(jkr_neighbors.max_neighbors)
+        # call the cuda kernel once to count the edges of each cell
+        backend.jkr_neighbors_gpu[bpg, tpb](bin_locations_cuda, locations_cuda, radii_cuda, bins_cuda,
+                                            bins_help_cuda, bins_start_cuda, bins_table_cuda,
+                                            cuda.to_device(edge_holder), cuda.to_device(edge_start), edge_count_cuda,
+                                            cuda.to_device(False))
+        edge_count = edge_count_cuda.copy_to_host()
 
-            # allocate threads and blocks for gpu memory "threads per block" and "blocks per grid"
-            tpb = 72
-            bpg = math.ceil(simulation.number_cells / tpb)
+        # get where the edges of each cell begin and make an edge holder that fits all of the edges
+        edge_start = np.cumsum(edge_count) - edge_count
+        edge_holder_cuda = cuda.to_device(np.empty((np.sum(edge_count), 2), dtype=int))
 
-            # call the cuda kernel with new gpu arrays
-            backend.jkr_neighbors_gpu[bpg, tpb](bin_locations_cuda, locations_cuda, radii_cuda, bins_cuda,
-                                                bins_help_cuda, edge_holder_cuda, if_edge_cuda, edge_count_cuda,
-                                                max_neighbors_cuda)
+        # call the cuda kernel again to fill the edge holder
+        backend.jkr_neighbors_gpu[bpg, tpb](bin_locations_cuda, locations_cuda, radii_cuda, bins_cuda,
+                                            bins_help_cuda, bins_start_cuda, bins_table_cuda, edge_holder_cuda,
+                                            cuda.to_device(edge_start), edge_count_cuda, cuda.to_device(True))
 
-            # return the only the following array(s) back from the gpu
-            edge_holder = edge_holder_cuda.copy_to_host()
-            if_edge = if_edge_cuda.copy_to_host()
-            edge_count = edge_count_cuda.copy_to_host()
+        # return the only the following array(s) back from the gpu
+        edge_holder = edge_holder_cuda.copy_to_host()
 
-        # call the jit cpu version
-        else:
-            edge_holder, if_edge, edge_count = backend.jkr_neighbors_cpu(simulation.number_cells, bin_locations,
-                                                                         simulation.locations, simulation.radii, bins,
-                                                                         bins_help, edge_holder, if_edge, edge_count,
-                                                                         jkr_neighbors.max_neighbors)
-
-        # either break the loop if all neighbors were accounted for or revalue the maximum number of neighbors
-        # based on the output of the function call and double it
-        max_neighbors = np.amax(edge_count)
-        if jkr_neighbors.max_neighbors >= max_neighbors:
-            break
-        else:
-            jkr_neighbors.max_neighbors = max_neighbors * 2
+    # call the jit cpu version
+    else:
+        # use the version of the function specialized for a 2D space if the space has no depth
+        jkr_neighbors_cpu = backend.jkr_neighbors_cpu_2d if simulation.size[2] == 0 else backend.jkr_neighbors_cpu
 
-    # reduce the edges to only nonzero edges
-    edge_holder = edge_holder[if_edge]
+        # call the function once to count the edges of each cell
+        edge_holder, edge_count = jkr_neighbors_cpu(simulation.number_cells, bin_locations,
+                                                    simulation.locations, simulation.radii, bins, bins_help,
+                                                    bins_start, bins_table, edge_holder, edge_start, edge_count, False)
 
-    # add the edges and simplify the graph as this graph is never cleared due to its use for holding adhesive JKR
-    # bonds from step to step
-    simulation.jkr_graph.add_edges(edge_holder)
-    simulation.jkr_graph.simplify()
+        # get where the edges of each cell begin and make an edge holder that fits all of the edges
+        edge_start = np.cumsum(edge_count) - edge_count
+        edge_holder = np.empty((np.sum(edge_count), 2), dtype=int)
+
+        # call the function again to fill the edge holder
+        edge_holder, edge_count = jkr_neighbors_cpu(simulation.number_cells, bin_locations,
+                                                    simulation.locations, simulation.radii, bins, bins_help,
+                                                    bins_start, bins_table, edge_holder, edge_start, edge_count, True)
+
+    return edge_holder
 
 
 @backend.record_time
@@ -592,13 +600,18 @@ def get_forces(simulation):
     poisson = 0.5    # Poisson's ratio for the cells, 0.5 means incompressible
     youngs = 1000    # Young's modulus for the cells in Pa
 
-    # get the edges as a numpy array, count them, and create an array used to delete edges from the JKR graph
-    jkr_edges = np.array(simulation.jkr_graph.get_edgelist())
+    # get the array of edges, count them, and create an array used to delete edges from the JKR graph
+    jkr_edges = simulation.jkr_graph.get_edgelist()
     number_edges = len(jkr_edges)
     delete_edges = np.zeros(number_edges, dtype=bool)
 
     # only continue if edges exist, if no edges compiled functions will raise errors
     if number_edges > 0:
+        # the force of each edge is held separately and then summed for each cell over the edges of the cell in a
+        # fixed order, which avoids threads adding to the same cell at once and makes the forces reproducible
+        edge_forces = np.zeros((number_edges, 3), dtype=float)
+        incident_start, incident = backend.bond_incidence(simulation.number_cells, jkr_edges)
+
         # send the following as arrays to the gpu
         if simulation.parallel:
             # turn the following into arrays that can be interpreted by the gpu
@@ -606,7 +619,10 @@ def get_forces(simulation):
             delete_edges_cuda = cuda.to_device(delete_edges)
             locations_cuda = cuda.to_device(simulation.locations)
             radii_cuda = cuda.to_device(simulation.radii)
+            edge_forces_cuda = cuda.to_device(edge_forces)
             forces_cuda = cuda.to_device(simulation.jkr_forces)
+            incident_start_cuda = cuda.to_device(incident_start)
+            incident_cuda = cuda.to_device(incident)
             poisson_cuda = cuda.to_device(poisson)
             youngs_cuda = cuda.to_device(youngs)
             adhesion_const_cuda = cuda.to_device(adhesion_const)
@@ -616,8 +632,12 @@ def get_forces(simulation):
             bpg = math.ceil(number_edges / tpb)
 
             # call the cuda kernel with new gpu arrays
-            backend.get_forces_gpu[bpg, tpb](jkr_edges_cuda, delete_edges_cuda, locations_cuda, radii_cuda, forces_cuda,
-                                             poisson_cuda, youngs_cuda, adhesion_const_cuda)
+            backend.get_forces_gpu[bpg, tpb](jkr_edges_cuda, delete_edges_cuda, locations_cuda, radii_cuda,
+                                             edge_forces_cuda, poisson_cuda, youngs_cuda, adhesion_const_cuda)
+
+            # sum the forces of the edges for each cell
+            bpg = math.ceil(simulation.number_cells / tpb)
+            backend.gather_forces_gpu[bpg, tpb](incident_start_cuda, incident_cuda, edge_forces_cuda, forces_cuda)
 
             # return the only the following array(s) back from the gpu
             forces = forces_cuda.copy_to_host()
@@ -625,13 +645,19 @@ def get_forces(simulation):
 
         # call the cpu version
         else:
-            forces, delete_edges = backend.get_forces_cpu(number_edges, jkr_edges, delete_edges, simulation.locations,
-                                                          simulation.radii, simulation.jkr_forces, poisson, youngs,
-                                                          adhesion_const)
+            # use the version of the function specialized for a 2D space if the space has no depth
+            get_forces_cpu = backend.get_forces_cpu_2d if simulation.size[2] == 0 else backend.get_forces_cpu
+
+            edge_forces, delete_edges = get_forces_cpu(number_edges, jkr_edges, delete_edges, simulation.locations,
+                                                       simulation.radii, edge_forces, poisson, youngs,
+                                                       adhesion_const)
+
+            # sum the forces of the edges for each cell
+            forces = backend.gather_forces_cpu(simulation.number_cells, incident_start, incident, edge_forces,
+                                               simulation.jkr_forces)
 
         # update the jkr edges to remove any edges that have be broken and update the JKR forces array
-        delete_edges_indices = np.arange(number_edges)[delete_edges]
-        simulation.jkr_graph.delete_edges(delete_edges_indices)
+        simulation.jkr_graph.delete_edges(delete_edges)
         simulation.jkr_forces = forces
 
 
@@ -674,15 +700,96 @@ def apply_forces(simulation, apply_motility=True):
 
     # call the cpu version
     else:
-        new_locations = backend.apply_forces_cpu(simulation.number_cells, simulation.jkr_forces, motility_forces,
-                                                 simulation.locations, simulation.radii, viscosity, simulation.size,
-                                                 simulation.move_dt)
+        # use the version of the function specialized for a 2D space if the space has no depth
+        apply_forces_cpu = backend.apply_forces_cpu_2d if simulation.size[2] == 0 else backend.apply_forces_cpu
+
+        new_locations = apply_forces_cpu(simulation.number_cells, simulation.jkr_forces, motility_forces,
+                                         simulation.locations, simulation.radii, viscosity, simulation.size,
+                                         simulation.move_dt)
 
     # update the locations and reset the jkr forces back to zero
     simulation.locations = new_locations
     simulation.jkr_forces[:, :] = 0
 
 
+@backend.record_time
+def relax_mechanics(simulation, number_substeps=None, apply_motility=True):
+    """ Moves the cells through the sub-steps of contact detection,
+        JKR bond update, force calculation, and movement in a single
+        compiled call, which is the same as calling jkr_neighbors(),
+        get_forces(), and apply_forces() for each sub-step. If the
+        adaptive option is on (see parameters.py), the sub-steps
+        vary in length to cover the same time and stop early once
+        the cells are at rest. If the sleep option is on, cells that
+        have been nearly still for a number of sub-steps are skipped
+        until woken by a force, a new contact, division, or death.
+    """
+    # contact mechanics parameters that rarely change
+    adhesion_const = 0.000107    # the adhesion constant in kg/s from P Pathmanathan et al.
+    poisson = 0.5    # Poisson's ratio for the cells, 0.5 means incompressible
+    youngs = 1000    # Young's modulus for the cells in Pa
+    viscosity = 10000    # the viscosity of the medium in Ns/m used for stokes friction
+
+    # default to the number of movement steps in a simulation step
+    if number_substeps is None:
+        number_substeps = simulation.move_steps
+
+    # the compiled loop only has a cpu version, so call the separate methods with fixed sub-steps if using the gpu
+    if simulation.parallel:
+        for _ in range(number_substeps):
+            jkr_neighbors(simulation)
+            get_forces(simulation)
+            apply_forces(simulation, apply_motility=apply_motility)
+        simulation.move_substeps += number_substeps
+        return
+
+    # if apply_motility is False an array of zeros will be used to prevent erroneous motility forces
+    if apply_motility:
+        motility_forces = simulation.motility_forces
+    else:
+        motility_forces = np.zeros_like(simulation.motility_forces)
+
+    # the furthest distance apart (meters) two cells can be while having a physical interaction
+    reach = 2 * max(simulation.max_radius, np.amax(simulation.radii, initial=0))
+
+    # start from the candidate pairs held by jkr_neighbors() if these can still be used (see NeighborList), the
+    # compiled loop always searches the bins for new pairs when needed
+    jkr_list = simulation.jkr_list
+    rebuild = jkr_list.pairs is None or len(jkr_list.locations) != simulation.number_cells or reach > jkr_list.reach
+    if rebuild:
+        pairs, pair_locations = np.zeros((0, 2), dtype=np.int64), simulation.locations[:simulation.number_cells]
+    else:
+        pairs, pair_locations = jkr_list.pairs.astype(np.int64, copy=False), jkr_list.locations
+
+    # cells only sleep if the model makes the "sleep_counters" cell array, otherwise (such as a simulation continued
+    # from before cells could sleep) all cells are kept awake
+    if hasattr(simulation, "sleep_counters"):
+        sleep_counters, sleep_steps = simulation.sleep_counters, simulation.sleep_steps
+        sleep_force, sleep_distance = simulation.sleep_force, simulation.sleep_distance
+    else:
+        sleep_counters, sleep_steps = np.zeros(len(simulation.locations), dtype=int), 0
+        sleep_force, sleep_distance = 0.0, 0.0
+
+    # call the compiled loop for all sub-steps
+    locations, bonds, pairs, pair_locations, rebuilt, substeps, sleep_counters = backend.relax_mechanics_jit(
+        number_substeps, simulation.number_cells, simulation.locations, simulation.radii, motility_forces,
+        simulation.jkr_graph.get_edgelist(), pairs, pair_locations, rebuild, reach, simulation.jkr_skin,
+        simulation.size, viscosity, simulation.move_dt, poisson, youngs, adhesion_const, simulation.size[2] == 0,
+        simulation.adaptive_move, simulation.move_tolerance, simulation.min_move_dt, simulation.rest_speed,
+        sleep_counters, sleep_steps, sleep_force, sleep_distance)
+
+    # count the sub-steps taken for the simulation data CSV
+    simulation.move_substeps += substeps
+
+    # update the locations, the sleep counters, the JKR bonds, and the held candidate pairs
+    simulation.locations = locations
+    simulation.jkr_graph.set_edges(bonds)
+    if hasattr(simulation, "sleep_counters"):
+        simulation.sleep_counters = sleep_counters
+    if rebuilt:
+        jkr_list.update(pairs, pair_locations, reach)
+
+
 @backend.record_time
 def update_diffusion(simulation, gradient_name, diffuse_const=None, diffuse_dt=None):
     """ Approximates the diffusion of the morphogen for the
@@ -746,6 +853,11 @@ def update_queue(simulation):
             # add the copies to the end of the array
             simulation.__dict__[name] = np.concatenate((simulation.__dict__[name], copies), axis=0)
 
+    # go through each graph adding the number of dividing cells at once, rather than growing the graph arrays for
+    # each cell
+    for graph_name in simulation.graph_names:
+        simulation.__dict__[graph_name].add_vertices(num_added)
+
     # go through each of the dividing cells
     for i in range(num_added):
         # get the indices of the mother cell and the daughter cell
@@ -761,9 +873,9 @@ def update_queue(simulation):
         simulation.radii[mother_index] = simulation.radii[daughter_index] = simulation.min_radius
         simulation.div_counters[mother_index] = simulation.div_counters[daughter_index] = 0
 
-        # go through each graph adding the number of dividing cells
-        for graph_name in simulation.graph_names:
-            simulation.__dict__[graph_name].add_vertex()
+        # wake both cells if sleeping (see relax_mechanics())
+        if hasattr(simulation, "sleep_counters"):
+            simulation.sleep_counters[mother_index] = simulation.sleep_counters[daughter_index] = 0
 
         # update the number of cells in the simulation
         simulation.number_cells += 1
@@ -779,14 +891,18 @@ def update_queue(simulation):
             # if the current number added is divisible by the group number
             if (i + 1) % simulation.group == 0:
                 # run the following once to better simulate asynchronous division
-                jkr_neighbors(simulation)
-                get_forces(simulation)
-                apply_forces(simulation, apply_motility=False)    # don't apply motility forces
+                relax_mechanics(simulation, 1, apply_motility=False)    # don't apply motility forces
 
     # -------------------- Death --------------------
     # get the indices of the cells leaving the simulation
     indices = simulation.cells_to_remove
 
+    # wake any cells bonded to the cells leaving the simulation (see relax_mechanics())
+    if hasattr(simulation, "sleep_counters"):
+        bonds = simulation.jkr_graph.get_edgelist()
+        losing = np.isin(bonds, indices).any(axis=1)
+        simulation.sleep_counters[bonds[losing].ravel()] = 0
+
     # go through the cell arrays remove the indices
     for name in simulation.cell_array_names:
         # if the array is 1-dimensional
@@ -804,3 +920,51 @@ def update_queue(simulation):
     # clear the arrays for the next step
     simulation.cells_to_divide = np.array([], dtype=int)
     simulation.cells_to_remove = np.array([], dtype=int)
+
+    # the cell indices have changed so the candidate pairs for JKR neighbors and the derived values are invalid
+    simulation.jkr_list.clear()
+    simulation.clear_derived()
+
+
+@backend.record_time
+def reorder_cells(simulation, interval=10):
+    """ Every "interval" steps, sorts the cells along a space-filling
+        curve such that cells near each other in space are near each
+        other in the cell arrays, which improves memory access in the
+        neighbor searches.
+    """
+    # only reorder the cells on every "interval" step, 0 means never
+    if interval == 0 or simulation.current_step % interval != 0:
+        return
+
+    # get the new order of the cells, where order[new index] = old index, and the inverse of it for remapping cell
+    # indices held by the Simulation object, where inverse[old index] = new index
+    order = backend.morton_order(simulation.locations, 2 * simulation.max_radius)
+    inverse = np.empty_like(order)
+    inverse[order] = np.arange(simulation.number_cells)
+
+    # go through the cell arrays putting the cells in the new order
+    for name in simulation.cell_array_names:
+        simulation.__dict__[name] = simulation.__dict__[name][order]
+
+    # these cell arrays hold the indices of other cells (-1 for no cell), so change them to the new indices, these
+    # are only updated by nearest() so any index past the last cell (left by cell death) is changed to -1
+    for name in ["nearest_nanog", "nearest_gata6", "nearest_diff"]:
+        indices = simulation.__dict__[name]
+        valid = (indices != -1) & (indices < simulation.number_cells)
+        simulation.__dict__[name] = np.where(valid, inverse[np.where(valid, indices, 0)], -1)
+
+    # change the cell indices of the edges in each graph
+    for graph_name in simulation.graph_names:
+        graph = simulation.__dict__[graph_name]
+        edges = np.array(graph.get_edgelist(), dtype=int).reshape(-1, 2)
+        graph.delete_edges()
+        graph.add_edges(inverse[edges])
+
+    # change the indices of any cells waiting to divide or be removed
+    simulation.cells_to_divide = inverse[simulation.cells_to_divide]
+    simulation.cells_to_remove = inverse[simulation.cells_to_remove]
+
+    # the cell indices have changed so the candidate pairs for JKR neighbors and the derived values are invalid
+    simulation.jkr_list.clear()
+    simulation.clear_derived()
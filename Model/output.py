@@ -61,6 +61,10 @@ def step_image(simulation, background=(0, 0, 0), origin_bottom=True, fgf4_gradie
             # transpose the array to match the point location of OpenCV: (x, y) with origin top left
             grad_image = cv2.transpose(grad_image)
 
+        # get the type of each cell
+        if_diff = simulation.get_derived("if_diff")
+        if_gata6 = simulation.get_derived("if_gata6")
+
         # go through all of the cells
         for index in range(simulation.number_cells):
             # get xy coordinates and the axis lengths
@@ -70,18 +74,18 @@ def step_image(simulation, background=(0, 0, 0), origin_bottom=True, fgf4_gradie
 
             # color the cells according to the mode
             if simulation.color_mode:
-                if simulation.states[index] == "Differentiated":
+                if if_diff[index]:
                     color = (0, 0, 230)    # red
-                elif simulation.GATA6[index] > simulation.NANOG[index]:
+                elif if_gata6[index]:
                     color = (255, 255, 255)    # white
                 else:
                     color = (32, 252, 22)    # green
 
             # False yields coloring based on the finite dynamical system
             else:
-                if simulation.states[index] == "Differentiated":
+                if if_diff[index]:
                     color = (0, 0, 230)    # red
-                elif simulation.GATA6[index] > simulation.NANOG[index]:
+                elif if_gata6[index]:
                     color = (255, 255, 255)    # white
                 elif simulation.GATA6[index] == simulation.NANOG[index] == simulation.field - 1:
                     color = (30, 255, 255)    # yellow
@@ -133,8 +137,11 @@ def step_values(simulation):
 
             # go through each of the cell arrays
             for array_name in simulation.cell_array_names:
-                # get the cell array
-                cell_array = simulation.__dict__[array_name]
+                # get the cell array, using the labels instead of the codes for a categorical array
+                if array_name in simulation.categories:
+                    cell_array = simulation.get_labels(array_name)
+                else:
+                    cell_array = simulation.__dict__[array_name]
 
                 # if the array is one dimensional
                 if cell_array.ndim == 1:
@@ -194,7 +201,7 @@ def step_tda(simulation, in_pixels=False):
         directory_path = check_direct(simulation.paths.tda)
 
         # get the indices as an array of True/False of gata6 high cells and the non gata6 high cells
-        red_indices = simulation.GATA6 > simulation.NANOG
+        red_indices = simulation.get_derived("if_gata6")
         green_indices = np.invert(red_indices)
 
         # if TDA locations should be based on pixel location
@@ -257,7 +264,7 @@ def simulation_data(simulation):
         # create header if this is the beginning of a new simulation
         if simulation.current_step == 1:
             # header names
-            header = ["Step Number", "Number Cells", "Step Time", "Memory (MB)"]
+            header = ["Step Number", "Number Cells", "Step Time", "Memory (MB)", "Movement Sub-steps"]
 
             # header with all the names of the functions with the "record_time" decorator
             functions_header = list(simulation.method_times.keys())
@@ -271,7 +278,7 @@ def simulation_data(simulation):
         memory = process.memory_info()[0] / 1024 ** 2
 
         # write the row with the corresponding values
-        columns = [simulation.current_step, simulation.number_cells, step_time, memory]
+        columns = [simulation.current_step, simulation.number_cells, step_time, memory, simulation.move_substeps]
         function_times = list(simulation.method_times.values())
         csv_object.writerow(columns + function_times)
 
@@ -279,6 +286,9 @@ def simulation_data(simulation):
         for method_name in simulation.method_times.keys():
             simulation.method_times[method_name] = 0
 
+        # reset the count of movement sub-steps for the next step
+        simulation.move_substeps = 0
+
 
 def create_video(simulation, fps=10):
     """ Take all of the images outputted by a simulation and
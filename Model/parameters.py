@@ -1,8 +1,7 @@
 import numpy as np
-import igraph
 import math
 import input
-from backend import Base
+from backend import Base, AdjacencyGraph, BondGraph, RandomStreams
 
 
 class Simulation(Base):
@@ -34,6 +33,12 @@ class Simulation(Base):
         self.num_gata6 = input.get_parameter(general_path, 14, int)
         self.size = np.array(input.get_parameter(general_path, 17, tuple))
         self.order_66 = input.get_parameter(general_path, 20, str)
+        self.search_method = input.get_parameter(general_path, 24, str)
+        self.seed = input.get_parameter(general_path, 28, str)
+
+        # make the source of random numbers with the seed, None for a different seed each time
+        self.seed = None if self.seed == "None" else int(self.seed)
+        self.rng = RandomStreams(self.seed)
 
         # ------------- outputs template file ------------------------------
         outputs_path = paths.templates + "outputs.txt"    # path to outputs.txt template file
@@ -59,8 +64,32 @@ class Simulation(Base):
         self.diffuse_dt = 0.23  # dt for stable diffusion model (0.5 sec)
         self.move_steps = math.ceil(self.step_dt / self.move_dt)
 
-        # the field for the finite dynamical system
+        # if adaptive, relax_mechanics() covers the time of the move steps with sub-steps as long as possible without
+        # any cell moving more than the tolerance (meters), though no shorter than the min dt (seconds), and stops
+        # early once the fastest cell is slower than the rest speed (meters/sec)
+        self.adaptive_move = False
+        self.move_tolerance = 0.000001    # 1 um
+        self.min_move_dt = 20    # 20 sec
+        self.rest_speed = 0.00000000001    # 0.00001 um/s
+
+        # if above 0, cells in relax_mechanics() sleep after this many sub-steps in a row with a net force (newtons)
+        # and movement (meters) below the thresholds, skipping the bonds between sleeping cells and the movement of
+        # sleeping cells until woken, use 0 to keep all cells awake
+        self.sleep_steps = 0
+        self.sleep_force = 0.00000000001    # 0.00001 nN
+        self.sleep_distance = 0.00000001    # 0.01 um
+
+        # the skin (meters) added to the search radius for JKR neighbors such that the pairs of cells found can be
+        # reused over multiple movement steps, use 0 to search for JKR neighbors every movement step
+        self.jkr_skin = 0.000002    # 2 um
+
+        # the field for the finite dynamical system and its update functions, None uses the boolean or ternary
+        # functions (see backend.fds_functions()), these are precompiled into a lookup table when first used and
+        # again whenever the field or functions are changed
         self.field = 3
+        self.fds_functions = None
+        self.fds_table = None
+        self.fds_table_key = None    # the field and functions the lookup table was made from
 
         # the rates (in steps) of division, differentiation, death, and finite dynamical system updating
         self.pluri_div_thresh = 36
@@ -75,10 +104,10 @@ class Simulation(Base):
         self.pluri_growth = (self.max_radius - self.min_radius) / self.pluri_div_thresh
         self.diff_growth = (self.max_radius - self.min_radius) / self.diff_div_thresh
 
-        # the neighbor graph holds all nearby cells within a fixed radius, and the JKR graph is used for
-        # storing adhesive bonds between cells
-        self.neighbor_graph = igraph.Graph()
-        self.jkr_graph = igraph.Graph()
+        # the neighbor graph holds all nearby cells within a fixed radius as CSR arrays, and the JKR graph holds
+        # the adhesive bonds between cells as an array of unique pairs
+        self.neighbor_graph = AdjacencyGraph()
+        self.jkr_graph = BondGraph()
 
         # add the names of the graphs below for automatic cell addition and removal
         self.graph_names = ["neighbor_graph", "jkr_graph"]
@@ -1,6 +1,3 @@
-import numpy as np
-import random as r
-
 import input
 import output
 import functions
@@ -38,29 +35,42 @@ def setup_cells(simulation):
     simulation.add_cells(simulation.num_nanog)
     simulation.add_cells(simulation.num_gata6, cell_type="GATA6_high")
 
+    # Get the source of random numbers, which draws the random initial conditions for all of the cells at once.
+    rng, number_cells = simulation.rng, simulation.number_cells
+
     # Create the following cell arrays with initial conditions.
-    simulation.cell_array("locations", override=np.random.rand(simulation.number_cells, 3) * simulation.size)
+    simulation.cell_array("locations", override=rng.random((number_cells, 3)) * simulation.size)
     simulation.cell_array("radii", func=lambda: simulation.min_radius)
     simulation.cell_array("motion", dtype=bool, func=lambda: True)
-    simulation.cell_array("FGFR", dtype=int, func=lambda: r.randrange(0, simulation.field))
-    simulation.cell_array("ERK", dtype=int, func=lambda: r.randrange(0, simulation.field))
+    simulation.cell_array("FGFR", override=rng.integers(0, simulation.field, number_cells))
+    simulation.cell_array("ERK", override=rng.integers(0, simulation.field, number_cells))
     simulation.cell_array("GATA6", dtype=int)
-    simulation.cell_array("NANOG", dtype=int, func=lambda: r.randrange(1, simulation.field))
-    simulation.cell_array("states", dtype=str, func=lambda: "Pluripotent")
-    simulation.cell_array("death_counters", dtype=int, func=lambda: r.randrange(0, simulation.death_thresh))
-    simulation.cell_array("diff_counters", dtype=int, func=lambda: r.randrange(0, simulation.pluri_to_diff))
-    simulation.cell_array("div_counters", dtype=int, func=lambda: r.randrange(0, simulation.pluri_div_thresh))
-    simulation.cell_array("fds_counters", dtype=int, func=lambda: r.randrange(0, simulation.fds_thresh))
+    simulation.cell_array("NANOG", override=rng.integers(1, simulation.field, number_cells))
+    simulation.cell_array("states", categories=["Pluripotent", "Differentiated"], func=lambda: "Pluripotent")
+    simulation.cell_array("death_counters", override=rng.integers(0, simulation.death_thresh, number_cells))
+    simulation.cell_array("diff_counters", override=rng.integers(0, simulation.pluri_to_diff, number_cells))
+    simulation.cell_array("div_counters", override=rng.integers(0, simulation.pluri_div_thresh, number_cells))
+    simulation.cell_array("fds_counters", override=rng.integers(0, simulation.fds_thresh, number_cells))
     simulation.cell_array("motility_forces", vector=3)
     simulation.cell_array("jkr_forces", vector=3)
+    simulation.cell_array("sleep_counters", dtype=int)
     simulation.cell_array("nearest_nanog", dtype=int, func=lambda: -1)
     simulation.cell_array("nearest_gata6", dtype=int, func=lambda: -1)
     simulation.cell_array("nearest_diff", dtype=int, func=lambda: -1)
 
     # Update the "GATA6_high" cells with alternative initial conditions.
-    simulation.cell_array("GATA6", cell_type="GATA6_high", func=lambda: r.randrange(1, simulation.field))
+    simulation.cell_array("GATA6", cell_type="GATA6_high", func=lambda: rng.integers(1, simulation.field))
     simulation.cell_array("NANOG", cell_type="GATA6_high", func=lambda: 0)
 
+    # Register the per-cell rules, which are compiled into a single pass over the cells by cell_rules(). Each rule is
+    # called in this order for a cell and is followed by the names of the Simulation attributes it uses as parameters
+    # and the names of the cell arrays it uses.
+    simulation.rules.register(functions.death_rule, "lonely_thresh", "death_thresh", arrays=["death_counters"])
+    simulation.rules.register(functions.diff_surround_rule, "field", arrays=["GATA6", "NANOG"])
+    simulation.rules.register(functions.division_rule, "pluri_div_thresh", "diff_div_thresh", arrays=["div_counters"])
+    simulation.rules.register(functions.growth_rule, "max_radius", "min_radius", "pluri_growth", "diff_growth",
+                              arrays=["radii", "div_counters"])
+
 
 def steps(simulation):
     """ This method is used to specify the order of the methods that
@@ -83,11 +93,9 @@ def steps(simulation):
         functions.get_neighbors(simulation, distance=0.000015)
 
         # Updates cells by adjusting trackers for differentiation, division, growth, etc. based on intracellular,
-        # intercellular, and extracellular conditions through a series of separate methods.
-        functions.cell_death(simulation)
-        functions.cell_diff_surround(simulation)
-        functions.cell_division(simulation)
-        functions.cell_growth(simulation)
+        # intercellular, and extracellular conditions. The rules registered in setup_cells() are run together in a
+        # single pass over the cells, while the pathway depends on the order of the cells through the gradient.
+        functions.cell_rules(simulation)
         functions.cell_pathway(simulation)
 
         # Simulates molecular diffusion the specified extracellular gradient via the forward time centered space method.
@@ -98,6 +106,10 @@ def steps(simulation):
         # groups, the handle_movement() function will be used to better represent asynchronous division and death.
         functions.update_queue(simulation)
 
+        # Every so often, sorts the cells along a space-filling curve such that cells near each other in space are also
+        # near each other in the cell arrays. This improves memory access in the neighbor searches.
+        functions.reorder_cells(simulation, interval=10)
+
         # Finds the nearest NANOG high, GATA6 high, and differentiated cells within a fixed radius. This provides
         # information that can be used for approximating cell motility.
         functions.nearest(simulation, distance=0.000015)
@@ -107,12 +119,10 @@ def steps(simulation):
         functions.cell_motility(simulation)
         # functions.eunbi_motility(simulation)
 
-        # Through the series of methods, attempt to move the cells to a state of physical equilibrium between adhesive
-        # and repulsive forces acting on the cells, while applying active motility forces.
-        for _ in range(simulation.move_steps):
-            functions.jkr_neighbors(simulation)
-            functions.get_forces(simulation)
-            functions.apply_forces(simulation)
+        # Through a series of sub-steps, attempt to move the cells to a state of physical equilibrium between adhesive
+        # and repulsive forces acting on the cells, while applying active motility forces. All sub-steps of finding
+        # contacts, updating the JKR bonds, calculating forces, and moving the cells run in one compiled call.
+        functions.relax_mechanics(simulation, simulation.move_steps)
 
         # Saves multiple forms of information about the simulation at the current step, including an image of the
         # space, CSVs with values of the cells, a temporary pickle of the Simulation object, and performance stats.